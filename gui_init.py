@@ -7,7 +7,7 @@
 import cv2
 import numpy as np
 import os
-from PIL import Image, ImageFile
+from PIL import Image, ImageDraw, ImageFile, ImageFont
 import pandas as pd
 import time
 # from tqdm import tqdm
@@ -15,16 +15,40 @@ import scipy as sp
 import datetime
 from gpxcsv import gpxtolist
 import gc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import queue
 from alive_progress import alive_bar
-from pyfftw.interfaces.numpy_fft import fft2, ifft2, fftshift
 import pyfftw
-import simplekml
+import zipfile
+import io
+import zlib
+import struct
+import tempfile
+import json
+import hashlib
+import ast
+import re
+from xml.sax.saxutils import escape
 import imutils
-import matplotlib.pyplot as plt
-from matplotlib_scalebar.scalebar import ScaleBar
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    import av
+except ImportError:
+    av = None
 
-pyfftw.interfaces.cache.enable()
 NUM_THREADS = max(1, os.cpu_count() - 1)
+fft_plans = {}
+refine_patch = (64, 256)
+search_min_score = 0.5
+prefetch_size = 16
+seek_min_seconds = 2
+canvas_memory_limit = 2**30
+strip_rows = 1024
 
 os.environ["OPENCV_FFMPEG_READ_ATTEMPTS"] = "12288"
 os.environ['OPENCV_LOG_LEVEL'] = 'OFF'
@@ -59,6 +83,9 @@ NE = np.arange(90, 0, -angles_inc)
 NW = np.arange(360, 270-angles_inc, -angles_inc)
 NW[0] = 0 
 
+closing_kernel = np.ones((15,15),np.uint8)
+closing_halo = 16
+
 bearing_values = np.concatenate((SW,SE,NE,NW), axis = 0)
 
 bearing_conv = sp.interpolate.interp1d(angles, bearing_values,kind = 'linear', fill_value = 'extrapolate', bounds_error = False)
@@ -177,108 +204,431 @@ class GPSdata():
     def export(self):
         return self.gps_data
 
-def scan_frames(vid_dir, mosaics_dir, frame_interval):
-    currentframe = 0 
+def iterate_frames(cam, length, decode = True):
+    # Yields (frame_location, timestamp_ms, frame) for each of the `length` frames of a video.
+    # Frames that still cannot be read after the retries are yielded with a None timestamp and frame.
+    # Without decode, frames are only grabbed, which skips converting them into images, and the
+    # yielded frame is None.
+    read = cam.read if decode else lambda: (cam.grab(), None)
+    frame_location = 0
+    for i in range(length):
+        ret, frame = read()
+
+        # Retry until frame is valid (with safety break)
+        retry_count = 0
+        while not ret and retry_count < 10:
+            ret, frame = read()
+            frame_location += 1
+            retry_count += 1
+
+        if not ret:
+            yield frame_location, None, None
+            frame_location += 1
+            continue
+
+        yield frame_location, float(cam.get(cv2.CAP_PROP_POS_MSEC)), frame
+        frame_location += 1
+
+def prefetch(iterable, size = prefetch_size):
+    # Runs the iterable on a decoder thread that stays up to `size` items ahead of the consumer.
+    # OpenCV releases the GIL while decoding and resizing, so reading overlaps with registration.
+    items = queue.Queue(maxsize = size)
+    stop = threading.Event()
+    done = object()
+    failure = []
+
+    def put(item):
+        # Gives up once the consumer has stopped, so the thread never blocks on a full queue
+        while not stop.is_set():
+            try:
+                items.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    all_fps = []
-    for file_name in os.listdir(vid_dir):
-        if np.any([filetype in file_name.lower() for filetype in valid_video_types]):
-            data = cv2.VideoCapture(os.path.join(vid_dir, f"{file_name}"))
-            fps = data.get(cv2.CAP_PROP_FPS) 
-            all_fps.append(fps)
-    fps = np.mean(all_fps)
-    
-    if currentframe == 0:
-       frame_data = pd.DataFrame(columns = ["frame_number", "frame_location", "video_file", "frame_timestamp"])
-       frame_data.to_csv(os.path.join(mosaics_dir, "frame_scan_data.csv"))
-    
-    if currentframe != 0:
+    def produce():
         try:
-            frame_data = pd.read_csv(os.path.join(mosaics_dir, "frame_scan_data.csv"))
-        except:
-            print("ERROR: Could not locate previous frame scan data. Aborting process...")
-    
-    rows = []
-    for file_name in np.sort(os.listdir(vid_dir)):
-        if os.path.splitext(file_name)[1].lower() in valid_video_types:
-            frame_location = 0
-            cam = cv2.VideoCapture(os.path.join(vid_dir, file_name))
-            property_id = int(cv2.CAP_PROP_FRAME_COUNT)  
-            length = int(cv2.VideoCapture.get(cam, property_id)) 
-            with alive_bar(length, title=f"Scanning frames in {file_name}") as bar:
-                for i in range(length):
-                    ret, frame = cam.read()
-
-                    # Retry until frame is valid (with safety break)
-                    retry_count = 0
-                    while not ret and retry_count < 10:
-                        ret, frame = cam.read()
-                        frame_location += 1
-                        retry_count += 1
-
-                    if not ret:
-                        # Skip this frame if still invalid after retries
-                        currentframe += 1
-                        frame_location += 1
-                        bar()
-                        continue
-
-                    timestamp_ms = cam.get(cv2.CAP_PROP_POS_MSEC)
-
-                    if currentframe % frame_interval == 0:
-                        rows.append([
-                            currentframe,
-                            frame_location,
-                            file_name,
-                            float(timestamp_ms)
-                        ])
-                        last_usable_frame = currentframe
-
-                    currentframe += 1
-                    frame_location += 1
-                    bar()
-
-    frame_data = pd.DataFrame(rows, columns=frame_data.columns)
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as error:
+            failure.append(error)
+        put(done)
+
+    thread = threading.Thread(target = produce, daemon = True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        if failure:
+            raise failure[0]
+    finally:
+        stop.set()
+        thread.join()
+
+def decode_videos(vid_dir, video_files, lengths, frame_interval, video_res):
+    # Yields (file_name, frame_location, timestamp_ms, frame) for every frame of the videos, with
+    # the frames on the sampling interval already prepared for stitching and the others dropped
+    currentframe = 0
+    for file_name, length in zip(video_files, lengths):
+        cam = cv2.VideoCapture(os.path.join(vid_dir, file_name))
+        for frame_location, timestamp_ms, frame in iterate_frames(cam, length):
+            if frame is not None and currentframe % frame_interval == 0:
+                yield file_name, frame_location, timestamp_ms, prepare_frame(frame, video_res)
+            else:
+                yield file_name, frame_location, timestamp_ms, None
+            currentframe += 1
+        cam.release()
+
+def get_video_files(vid_dir):
+    return [file_name for file_name in np.sort(os.listdir(vid_dir)) if os.path.splitext(file_name)[1].lower() in valid_video_types]
+
+manifest_version = 1
+
+def save_manifest(path, data):
+    # Metadata passed between stages, as JSON tagged with the version of the manifest format
+    with open(path, 'w') as file:
+        json.dump({"version": manifest_version, **data}, file, indent = 1)
+
+def load_manifest(path, legacy_path):
+    # Reads a JSON manifest, or the str(dict) text file written by earlier versions
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            data = json.load(file)
+        if data.get("version", 0) > manifest_version:
+            raise ValueError(f"{path} was written by a newer version of CorStitch")
+        return data
+    with open(legacy_path, 'r') as file:
+        text = file.readline()
+    # Older files can hold numpy scalars such as np.float64(29.97), which are unwrapped first
+    return ast.literal_eval(re.sub(r"np\.\w+\(([^()]*)\)", r"\1", text))
+
+def save_table(path, columns, dtypes = None, categorical = ()):
+    # Columnar table as an npz file. Categorical columns are stored as integer codes into a list
+    # of their distinct values, so a video name takes a few bytes per frame instead of a string.
+    dtypes = dtypes or {}
+    arrays = {"version": manifest_version}
+    for name, values in columns.items():
+        if name in categorical:
+            codes, categories = pd.factorize(pd.Series(values, dtype = object))
+            arrays[f"{name}_code"] = codes.astype(np.int32)
+            arrays[f"{name}_categories"] = np.asarray(categories, dtype = str)
+        else:
+            arrays[name] = np.asarray(values, dtype = dtypes.get(name))
+    np.savez(path, **arrays)
+
+def load_table(path):
+    with np.load(path) as table:
+        if int(table["version"]) > manifest_version:
+            raise ValueError(f"{path} was written by a newer version of CorStitch")
+        columns = {}
+        for name in table.files:
+            if name.endswith("_categories") or name == "version":
+                continue
+            if name.endswith("_code"):
+                base = name[:-len("_code")]
+                columns[base] = table[f"{base}_categories"][table[name]]
+            else:
+                columns[name] = table[name]
+    return columns
+
+def save_frame_data(mosaics_dir, rows, fps, last_frame, frame_interval):
+    frame_data = pd.DataFrame(rows, columns = ["frame_number", "frame_location", "video_file", "frame_timestamp"])
     frame_data = frame_data.sort_values(by=["frame_number"])
-    frame_data.to_csv(os.path.join(mosaics_dir, "frame_scan_data.csv"), index = False)
-
-    cam.release() 
-    cv2.destroyAllWindows()
-    frame_meta_data = {
+    save_table(os.path.join(mosaics_dir, "frame_scan_data.npz"), {
+        "frame_number": frame_data["frame_number"].to_numpy(dtype = np.int64),
+        "frame_location": frame_data["frame_location"].to_numpy(dtype = np.int64),
+        "video_file": frame_data["video_file"].to_numpy(),
+        "frame_timestamp": frame_data["frame_timestamp"].to_numpy(dtype = float),
+    }, categorical = ["video_file"])
+
+    save_manifest(os.path.join(mosaics_dir, "frame_data.json"), {
         "time": str(datetime.datetime.now()),
-        "fps": fps,
-        "last_frame": last_usable_frame,
-        "frame_interval": frame_interval,
+        "fps": float(fps),
+        "last_frame": int(last_frame),
+        "frame_interval": int(frame_interval),
+    })
+
+def load_frame_data(mosaics_dir):
+    return load_manifest(os.path.join(mosaics_dir, "frame_data.json"), os.path.join(mosaics_dir, "frame_data.txt"))
+
+def load_frame_index(mosaics_dir):
+    # Array-backed view of the frame scan data, sorted by frame number so that mosaic windows
+    # can be cut with a binary search instead of scanning the whole table.
+    path = os.path.join(mosaics_dir, "frame_scan_data.npz")
+    if os.path.exists(path):
+        return load_table(path)
+    frame_data = pd.read_csv(os.path.join(mosaics_dir, "frame_scan_data.csv"))
+    frame_data = frame_data.sort_values(by=["frame_number"])
+    return {
+        "frame_number": frame_data["frame_number"].to_numpy(),
+        "frame_location": frame_data["frame_location"].to_numpy(),
+        "video_file": frame_data["video_file"].to_numpy(),
+        "frame_timestamp": frame_data["frame_timestamp"].to_numpy(dtype = float),
     }
-    with open(os.path.join(mosaics_dir, "frame_data.txt"), 'w') as file:
-        file.write(str(frame_meta_data))
-    return last_usable_frame
-    
 
-def matching(im1, im2, yc, xc, threshold):
-    Fim1= fft2(im1, threads=NUM_THREADS)
-    Fim2= fft2(im2, threads=NUM_THREADS)
-    cc = np.conj(Fim1)*Fim2
-    pc = cc/(abs(cc) + 1e-20)
+def video_signature(path, sample_size = 2**20):
+    # Identifies a video by its size, modification time and a hash of its first and last megabyte,
+    # which is enough to notice a replaced or re-copied clip without reading all of it
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        digest.update(file.read(sample_size))
+        file.seek(max(0, stat.st_size - sample_size))
+        digest.update(file.read(sample_size))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+def frame_index_path(mosaics_dir, file_name):
+    return os.path.join(mosaics_dir, "frame_index", f"{file_name}.npz")
+
+def load_video_index(mosaics_dir, file_name, signature, full_decode = False):
+    # Cached frame locations and timestamps of every frame of a video (NaN for unreadable frames)
+    # and its frame rate, or None when the video changed since it was scanned or when a decoded
+    # index is asked for and the video was only indexed from its container metadata
+    path = frame_index_path(mosaics_dir, file_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as index:
+            if any(str(index[key]) != str(value) for key, value in signature.items()):
+                return None
+            if full_decode and not index["decoded"]:
+                return None
+            return index["frame_location"], index["frame_timestamp"], float(index["fps"])
+    except:
+        return None
+
+def save_video_index(mosaics_dir, file_name, signature, frame_locations, timestamps, fps, decoded = True):
+    path = frame_index_path(mosaics_dir, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    np.savez(path, frame_location = np.asarray(frame_locations, dtype = np.int64), frame_timestamp = np.asarray(timestamps, dtype = float), fps = fps, decoded = decoded, **signature)
+
+def demux_video(path, length):
+    # Frame locations and timestamps of a video read from the packet headers of its container,
+    # without decoding any frame. The timestamps are computed the way OpenCV reports
+    # CAP_PROP_POS_MSEC. Returns None when a packet is corrupt or lacks a timestamp, or when the
+    # stream has fewer packets than frames, since OpenCV could then fail to read some frames.
+    try:
+        with av.open(path) as container:
+            stream = container.streams.video[0]
+            start_time = stream.start_time or 0
+            time_base = stream.time_base.numerator/stream.time_base.denominator
+            pts = []
+            for packet in container.demux(stream):
+                if packet.size == 0:
+                    continue
+                if packet.is_corrupt or packet.pts is None or (not pts and not packet.is_keyframe):
+                    return None
+                pts.append(packet.pts)
+    except:
+        return None
+    pts = np.sort(np.array(pts, dtype = np.int64))
+    if len(pts) < length or np.any(np.diff(pts) <= 0):
+        return None
+    return np.arange(length, dtype = np.int64), (pts[:length] - start_time)*time_base*1000
+
+def scan_video(vid_dir, file_name, full_decode = False, progress = True):
+    # Indexes the frames of a video from its container metadata when PyAV is available, and
+    # otherwise by grabbing every frame. Videos with frames that cannot be grabbed before their
+    # last readable frame are scanned again with full decoding, which is what the frame reader
+    # does with them. Damage inside the frame data is only noticed by decoding, so full_decode
+    # scans every video that way, and only such scans are marked as decoded in the index.
+    path = os.path.join(vid_dir, file_name)
+    cam = cv2.VideoCapture(path)
+    length = int(cam.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cam.get(cv2.CAP_PROP_FPS)
+    index = demux_video(path, length) if av is not None and not full_decode else None
+    if index is not None:
+        cam.release()
+        return *index, fps, False
+
+    for decode in ((True,) if full_decode else (False, True)):
+        frame_locations = np.zeros(length, dtype = np.int64)
+        timestamps = np.full(length, np.nan)
+        with alive_bar(length, title=f"Scanning frames in {file_name}", disable = not progress) as bar:
+            for i, (frame_location, timestamp_ms, frame) in enumerate(prefetch(iterate_frames(cam, length, decode))):
+                frame_locations[i] = frame_location
+                if timestamp_ms is not None:
+                    timestamps[i] = timestamp_ms
+                bar()
+        # Frames failing after the last readable one are usually an overestimated frame count, which
+        # fails the same way when decoding, so only gaps before it call for a full decode
+        readable = np.flatnonzero(~np.isnan(timestamps))
+        if decode or len(readable) == 0 or not np.any(np.isnan(timestamps[:readable[-1]])):
+            break
+        print(f"{file_name} has frames that could not be read. Scanning it again with full decoding...")
+        cam.release()
+        cam = cv2.VideoCapture(path)
+    cam.release()
+    return frame_locations, timestamps, fps, decode
+
+def scan_video_job(args):
+    # Worker entry point of the parallel frame scan, without a progress bar per video
+    vid_dir, file_name, full_decode = args
+    return scan_video(vid_dir, file_name, full_decode, progress = False)
+
+def scan_frames(vid_dir, mosaics_dir, frame_interval, full_decode = False, workers = 1):
+    # Every frame of every video is indexed once and cached under mosaics_dir, so rescans only
+    # decode new or modified videos. The frame interval is applied to the cached index.
+    video_files = get_video_files(vid_dir)
+    signatures = {file_name: video_signature(os.path.join(vid_dir, file_name)) for file_name in video_files}
+    indexes = {}
+    for file_name in video_files:
+        indexes[file_name] = load_video_index(mosaics_dir, file_name, signatures[file_name], full_decode)
+        if indexes[file_name] is not None:
+            print(f"{file_name} was already scanned. Using its cached frame index...")
+    unscanned = [file_name for file_name in video_files if indexes[file_name] is None]
+
+    if workers > 1 and len(unscanned) > 1:
+        # Videos are scanned independently, each by its own worker, and merged in file order below
+        with ProcessPoolExecutor(max_workers = min(workers, len(unscanned))) as executor:
+            scanned = executor.map(scan_video_job, [(vid_dir, file_name, full_decode) for file_name in unscanned])
+            with alive_bar(len(unscanned), title = f"Scanning frames in {len(unscanned)} videos...") as bar:
+                for file_name, (*index, decoded) in zip(unscanned, scanned):
+                    save_video_index(mosaics_dir, file_name, signatures[file_name], *index, decoded)
+                    indexes[file_name] = index
+                    bar()
+    else:
+        for file_name in unscanned:
+            *index, decoded = scan_video(vid_dir, file_name, full_decode)
+            save_video_index(mosaics_dir, file_name, signatures[file_name], *index, decoded)
+            indexes[file_name] = index
 
-    recon_cc = np.abs(fftshift(ifft2(cc, threads=NUM_THREADS)))
-    recon_pc = np.abs(fftshift(ifft2(pc, threads=NUM_THREADS)))
+    # Frame numbers run on across the videos, so each video is offset by the frames before it
+    currentframe = 0
+    rows = []
+    all_fps = []
+    for file_name in video_files:
+        frame_locations, timestamps, fps = indexes[file_name]
+        all_fps.append(fps)
 
-    py_cc, px_cc = np.unravel_index(recon_cc.argmax(), recon_cc.shape)
-    py_pc, px_pc = np.unravel_index(recon_pc.argmax(), recon_pc.shape)
+        frame_numbers = currentframe + np.arange(len(timestamps))
+        sampled = ~np.isnan(timestamps) & (frame_numbers % frame_interval == 0)
+        rows.extend([frame_number, frame_location, file_name, timestamp_ms] for frame_number, frame_location, timestamp_ms in zip(frame_numbers[sampled].tolist(), frame_locations[sampled].tolist(), timestamps[sampled].tolist()))
+        currentframe += len(timestamps)
 
-    if np.sqrt((py_pc - yc)**2 + (px_pc-xc)**2) <= threshold:
-        py, px = py_pc, px_pc
-        chosen = "pc"
-    else:
-        py, px = py_cc, px_cc
-        chosen = "cc"
+    last_usable_frame = rows[-1][0]
+    cv2.destroyAllWindows()
+    save_frame_data(mosaics_dir, rows, np.mean(all_fps), last_usable_frame, frame_interval)
+    return last_usable_frame
+    
 
-    return py, px, [py_pc, px_pc, py_cc, px_cc, chosen]
+def get_fft_plans(shape):
+    # FFTW plans are built once per strip shape and thread count, and reused for every strip
+    key = (shape, NUM_THREADS)
+    if key not in fft_plans:
+        fft_plans[key] = (
+            pyfftw.builders.fft2(pyfftw.empty_aligned(shape, dtype = 'complex128'), threads = NUM_THREADS, planner_effort = 'FFTW_MEASURE'),
+            pyfftw.builders.ifft2(pyfftw.empty_aligned(shape, dtype = 'complex128'), threads = NUM_THREADS, planner_effort = 'FFTW_MEASURE'),
+        )
+    return fft_plans[key]
+
+def local_shift(im, reference, dy, dx, radius):
+    # Searches for the shift of `im` against `reference` within `radius` pixels of (dy, dx) by
+    # template matching a patch of their overlap at full resolution. Returns the shift, the
+    # normalized correlation of the best match, and whether that match lies on the search border.
+    height, width = im.shape
+    top, bottom = max(0, -dy) + radius, min(height, height - dy) - radius
+    left, right = max(0, -dx) + radius, min(width, width - dx) - radius
+    if bottom - top < 8 or right - left < 8:
+        return dy, dx, None, True
+    patch_h, patch_w = min(bottom - top, refine_patch[0]), min(right - left, refine_patch[1])
+    top, left = (top + bottom - patch_h)//2, (left + right - patch_w)//2
+
+    template = im[top : top + patch_h, left : left + patch_w]
+    if template.min() == template.max():
+        return dy, dx, None, True
+    search = reference[top + dy - radius : top + dy + patch_h + radius, left + dx - radius : left + dx + patch_w + radius]
+    response = cv2.matchTemplate(search, template, cv2.TM_CCOEFF_NORMED)
+    # Flat patches such as open water or black borders have no defined correlation
+    response = np.nan_to_num(response, nan = -1, posinf = -1, neginf = -1)
+    ry, rx = np.unravel_index(response.argmax(), response.shape)
+    on_border = ry in (0, 2*radius) or rx in (0, 2*radius)
+    return dy + ry - radius, dx + rx - radius, response[ry, rx], on_border
+
+class StripRegistration():
+    # Phase correlation against a reference strip whose spectrum is kept between calls, with
+    # cross-correlation as the fallback when the phase correlation peak is too far off. A strip
+    # that gets stitched becomes the next reference without being transformed again, so each
+    # strip goes through one forward FFT.
+    # With a scale above 1 the shift is estimated on strips downscaled by that factor and then
+    # refined at full resolution, which cuts the FFT size by scale**2.
+    # With a search radius, the shift is first searched only around the last accepted shift,
+    # falling back to the full registration when no clear match is found there.
+    def __init__(self, shape, yc, xc, threshold, scale = 1, search_radius = 0):
+        self.shape = shape
+        self.scale = scale
+        self.search_radius = search_radius
+        self.coarse_shape = (shape[0]//scale, shape[1]//scale)
+        self.fft, self.ifft = get_fft_plans(self.coarse_shape)
+        self.yc, self.xc = yc, xc
+        self.coarse_yc, self.coarse_xc = self.coarse_shape[0]//2, self.coarse_shape[1]//2
+        self.threshold = threshold/scale
+        self.reference = None
+        self.candidate = None
+        self.last_shift = None
+
+    def downscale(self, im):
+        if self.scale == 1:
+            return im
+        return cv2.resize(im, dsize = (self.coarse_shape[1], self.coarse_shape[0]), interpolation = cv2.INTER_AREA)
+
+    def set_reference(self, im):
+        # The spectrum of the reference is computed on first use
+        self.reference = (im, None)
+        self.last_shift = None
+
+    def spectrum(self, im):
+        return self.fft(self.downscale(im)).copy()
+
+    def match(self, im):
+        if self.search_radius > 0 and self.last_shift is not None:
+            dy, dx, score, on_border = local_shift(im, self.reference[0], *self.last_shift, self.search_radius)
+            if score is not None and score >= search_min_score and not on_border:
+                self.candidate = (im, None, (dy, dx))
+                return self.yc + dy, self.xc + dx, [None, None, None, None, "window"]
+
+        if self.reference[1] is None:
+            self.reference = (self.reference[0], self.spectrum(self.reference[0]))
+        spectrum = self.spectrum(im)
+        cc = np.conj(spectrum)*self.reference[1]
+        pc = cc/(abs(cc) + 1e-20)
+
+        recon_pc = np.abs(np.fft.fftshift(self.ifft(pc)))
+        py_pc, px_pc = np.unravel_index(recon_pc.argmax(), recon_pc.shape)
+
+        if np.sqrt((py_pc - self.coarse_yc)**2 + (px_pc-self.coarse_xc)**2) <= self.threshold:
+            py, px = self.full_resolution(im, py_pc, px_pc)
+            self.candidate = (im, spectrum, (py - self.yc, px - self.xc))
+            return py, px, [py_pc, px_pc, None, None, "pc"]
+
+        # The cross-correlation is only needed when the phase correlation peak is rejected
+        recon_cc = np.abs(np.fft.fftshift(self.ifft(cc)))
+        py_cc, px_cc = np.unravel_index(recon_cc.argmax(), recon_cc.shape)
+
+        py, px = self.full_resolution(im, py_cc, px_cc)
+        self.candidate = (im, spectrum, (py - self.yc, px - self.xc))
+        return py, px, [py_pc, px_pc, py_cc, px_cc, "cc"]
+
+    def full_resolution(self, im, py, px):
+        if self.scale == 1:
+            return py, px
+        dy, dx, score, on_border = local_shift(im, self.reference[0], (py - self.coarse_yc)*self.scale, (px - self.coarse_xc)*self.scale, self.scale)
+        return self.yc + dy, self.xc + dx
+
+    def accept(self):
+        self.reference = self.candidate[0:2]
+        self.last_shift = self.candidate[2]
 
 def get_imgdim(path):
-    image = np.array(Image.open(path))
-    return image.shape[0], image.shape[1]
+    # Only the PNG header is read, the pixel data is never decoded
+    with Image.open(path) as image:
+        width, height = image.size
+    return height, width
 
 def remove_bad_substrings(s):
     badSubstring = ".jpg"
@@ -286,20 +636,560 @@ def remove_bad_substrings(s):
     return s
 
 
-def mosaic_creation(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res):
+def prepare_frame(frame, video_res):
+    frame = cv2.resize(frame, dsize = resolutions[video_res], interpolation = cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+class MosaicCanvas():
+    # Mosaic buffer addressed in mosaic coordinates, where `origin` is the mosaic coordinate of the
+    # first buffer pixel. It is allocated once from the expected mosaic size, grows geometrically
+    # only when a strip lands outside of it, and keeps the bounding box of the placed strips.
+    # With a scratch_dir, the buffer is a memory-mapped temporary file there instead of memory,
+    # which the system removes once the canvas and the mosaics cropped from it are released.
+    def __init__(self, shape, origin, dtype = np.uint8, scratch_dir = None):
+        self.scratch_dir = scratch_dir
+        self.buffer = self.allocate(shape, dtype)
+        self.origin_y, self.origin_x = origin
+        self.top, self.bottom, self.left, self.right = None, None, None, None
+
+    def allocate(self, shape, dtype):
+        if self.scratch_dir is None:
+            return np.zeros(shape, dtype)
+        return np.memmap(tempfile.TemporaryFile(dir = self.scratch_dir), dtype = dtype, mode = "w+", shape = shape)
+
+    def reserve(self, top, bottom, left, right):
+        height, width = self.buffer.shape[0:2]
+        grow_top = max(0, self.origin_y - top)
+        grow_bottom = max(0, bottom - (self.origin_y + height))
+        grow_left = max(0, self.origin_x - left)
+        grow_right = max(0, right - (self.origin_x + width))
+        if grow_top == grow_bottom == grow_left == grow_right == 0:
+            return
+
+        # Grow by at least the current size in each direction that is too small
+        grow_top = max(grow_top, height) if grow_top else 0
+        grow_bottom = max(grow_bottom, height) if grow_bottom else 0
+        grow_left = max(grow_left, width) if grow_left else 0
+        grow_right = max(grow_right, width) if grow_right else 0
+        buffer = self.allocate((height + grow_top + grow_bottom, width + grow_left + grow_right) + self.buffer.shape[2:], self.buffer.dtype)
+        if self.top is not None:
+            y0, y1 = self.top - self.origin_y, self.bottom - self.origin_y
+            x0, x1 = self.left - self.origin_x, self.right - self.origin_x
+            # Copied in bands so that a memory-mapped canvas is never read into memory at once
+            for y in range(y0, y1, strip_rows):
+                band = slice(y, min(y + strip_rows, y1))
+                buffer[band.start + grow_top : band.stop + grow_top, x0 + grow_left : x1 + grow_left] = self.buffer[band, x0:x1]
+        self.buffer = buffer
+        self.origin_y -= grow_top
+        self.origin_x -= grow_left
+
+    def place(self, strip, y, x):
+        height, width = strip.shape[0:2]
+        self.reserve(y, y + height, x, x + width)
+        self.buffer[y - self.origin_y : y - self.origin_y + height, x - self.origin_x : x - self.origin_x + width] = strip
+        if self.top is None:
+            self.top, self.bottom, self.left, self.right = y, y + height, x, x + width
+        else:
+            self.top, self.bottom = min(self.top, y), max(self.bottom, y + height)
+            self.left, self.right = min(self.left, x), max(self.right, x + width)
+
+    def crop(self):
+        return self.buffer[self.top - self.origin_y : self.bottom - self.origin_y, self.left - self.origin_x : self.right - self.origin_x]
+
+class MosaicStitcher():
+    def __init__(self, video_res, interval, registration_scale = 1, search_radius = 0, scratch_dir = None):
+        self.strip_width = int(int(video_res[:-1])*sl_ratio/2-1)
+        self.sl = resolutions[video_res][0]
+        self.yc, self.xc = resolutions[video_res][1]//2, resolutions[video_res][0]//2
+        self.upper_threshold = 0.2*self.sl
+        self.stitching_threshold = 0.5*self.sl
+        self.interval = interval
+        self.registration_scale = registration_scale
+        self.search_radius = search_radius
+        self.scratch_dir = scratch_dir
+        self.mosaic = None
+        self.origin = (0, 0)
+        self.registration_counts = {"window": 0, "pc": 0, "cc": 0}
+
+    def get_strip(self, frame):
+        return frame[self.yc - self.strip_width : self.yc + self.strip_width + 1]
+
+    def start(self, frame, num_frames):
+        self.strip1 = self.get_strip(frame)
+        self.registration = StripRegistration(self.strip1.shape[0:2], self.strip_width, self.xc, self.upper_threshold, self.registration_scale, self.search_radius)
+        self.registration.set_reference(np.ascontiguousarray(self.strip1[...,1]))
+        self.current_x = 0
+        self.current_y = 0
+
+        # Room for the strips expected to be stitched above and beside the first one
+        pad_x = int(self.sl*1.5)
+        pad_y = int(0.25*self.strip_width*num_frames)*self.interval
+        width = self.sl + 2*pad_x
+        if self.scratch_dir is not None and (self.strip1.shape[0] + pad_y)*width*3 > canvas_memory_limit:
+            # Mosaics that would not fit in memory, such as whole transects, are stitched on a
+            # memory-mapped canvas. It starts at the memory limit and grows with the transect
+            # instead of reserving the whole expected size on disk up front.
+            pad_y = max(0, canvas_memory_limit//(width*3) - self.strip1.shape[0])
+            self.mosaic = MosaicCanvas((self.strip1.shape[0] + pad_y, width, 3), (-pad_y, -pad_x), scratch_dir = self.scratch_dir)
+        else:
+            self.mosaic = MosaicCanvas((self.strip1.shape[0] + pad_y, width, 3), (-pad_y, -pad_x))
+        self.mosaic.place(self.strip1, self.current_y, self.current_x)
 
+    def add(self, frame):
+        strip2 = self.get_strip(frame)
+        try:
+            py, px, reg_stats  = self.registration.match(np.ascontiguousarray(strip2[...,1]))
+        except:
+            print("Matching failed. Skipping frame...")
+            return
+        self.registration_counts[reg_stats[4]] += 1
+        if np.sqrt((py - self.strip_width)**2 + (px-self.xc)**2) > self.stitching_threshold:
+            return
+
+        y_offset = py - self.strip_width
+        if y_offset <= 0:
+            x_offset = px - self.xc
+            self.current_x += x_offset 
+            self.current_y += y_offset
+            self.mosaic.place(strip2, self.current_y, self.current_x)
+
+            self.strip1 = strip2
+            self.registration.accept()
+
+    def finish(self):
+        # Position of the returned mosaic relative to the first strip of the window
+        self.origin = (self.mosaic.top, self.mosaic.left)
+        mosaic = self.mosaic.crop()
+        self.mosaic = None
+        return mosaic
+
+mosaic_formats = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+def mosaic_path(mosaics_dir, mosaic_name, image_format = "png"):
+    return os.path.join(mosaics_dir, f"{mosaic_name}{mosaic_formats[image_format]}")
+
+def mosaic_mask_path(path):
+    # JPEG mosaics keep their transparency in a separate grayscale PNG
+    return os.path.splitext(path)[0] + "_mask.png"
+
+def load_mosaic(path):
+    mosaic = np.array(Image.open(path).convert("RGBA"))
+    if os.path.splitext(path)[1] == mosaic_formats["jpeg"] and os.path.exists(mosaic_mask_path(path)):
+        # JPEG compression leaves noise in the black background, which the mask blanks out again
+        mosaic[..., 3] = np.array(Image.open(mosaic_mask_path(path)).convert("L"))
+        mosaic[mosaic[..., 3] == 0] = 0
+    return mosaic
+
+def save_mosaic(mosaic, path, origin = (0, 0), image_format = "png", compress_level = 6):
+    if isinstance(mosaic, np.memmap):
+        return save_mosaic_strips(mosaic, path, origin, compress_level)
+    non_black_rows = np.any(mosaic != [0, 0, 0], axis=(1, 2))
+    non_black_columns = np.any(mosaic != [0, 0, 0], axis=(0, 2))
+    crop_y = origin[0] + int(np.argmax(non_black_rows))
+    crop_x = origin[1] + int(np.argmax(non_black_columns))
+    mosaic = mosaic[non_black_rows, :]
+    mosaic = mosaic[:, non_black_columns]
+    mask = np.ones((mosaic.shape[0:2]))*255
+    black_region = mosaic == [0,0,0]
+    mask[black_region[...,0]] = 0
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, closing_kernel)
+    mask = mask.astype(np.uint8)
+    mosaic = Image.fromarray(mosaic.astype(np.uint8)).convert('RGB')
+    mask = Image.fromarray(mask.astype(np.uint8)).convert('L')
+    mosaic.putalpha(mask)
+    if image_format == "webp" and max(mosaic.size) > 16383:
+        # WebP cannot hold images this large
+        image_format = "png"
+        path = os.path.splitext(path)[0] + mosaic_formats["png"]
+    if image_format == "jpeg":
+        mosaic.convert("RGB").save(path, "JPEG", quality = 95)
+        mask.save(mosaic_mask_path(path), "PNG", compress_level = compress_level)
+    elif image_format == "webp":
+        mosaic.save(path, "WEBP", lossless = True, exact = True)
+    else:
+        mosaic.save(path, "PNG", compress_level = compress_level)
+    return [mosaic.width, mosaic.height, crop_x, crop_y, image_format]
+
+class PngStripWriter():
+    # Writes a PNG image strip by strip, compressing the rows into IDAT chunks as they arrive, so
+    # that images larger than memory can be saved. Rows use the Sub filter.
+    def __init__(self, path, width, height, compress_level = 6):
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, rows):
+        # rows is an (n, width, 4) RGBA array
+        rows = rows.reshape(rows.shape[0], -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:5] = rows[:, :4]
+        np.subtract(rows[:, 4:], rows[:, :-4], out = filtered[:, 5:])
+        self.add(self.compressor.compress(filtered.tobytes()))
+
+    def add(self, data, flush = False):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= 2**20 or flush:
+            self.chunk(b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        self.add(self.compressor.flush(), flush = True)
+        self.chunk(b"IEND", b"")
+        self.file.close()
+
+def save_mosaic_strips(mosaic, path, origin = (0, 0), compress_level = 6):
+    # save_mosaic for mosaics on a memory-mapped canvas. The black rows and columns are found and
+    # the image is masked and written strip by strip, so only a strip is ever held in memory. The
+    # closing of the mask reads closing_halo rows around each strip, which is more than the reach
+    # of closing_kernel, so the result matches closing the whole mask. These mosaics are always
+    # saved as PNG, the only format that can be written in strips.
+    non_black_rows = np.zeros(mosaic.shape[0], bool)
+    non_black_columns = np.zeros(mosaic.shape[1], bool)
+    for y in range(0, mosaic.shape[0], strip_rows):
+        non_black = np.any(mosaic[y : y + strip_rows] != 0, axis = 2)
+        non_black_rows[y : y + strip_rows] = np.any(non_black, axis = 1)
+        non_black_columns |= np.any(non_black, axis = 0)
+    crop_y = origin[0] + int(np.argmax(non_black_rows))
+    crop_x = origin[1] + int(np.argmax(non_black_columns))
+    rows = np.flatnonzero(non_black_rows)
+    columns = np.flatnonzero(non_black_columns)
+    height, width = len(rows), len(columns)
+
+    path = os.path.splitext(path)[0] + mosaic_formats["png"]
+    writer = PngStripWriter(path, width, height, compress_level)
+    try:
+        for y0 in range(0, height, strip_rows):
+            y1 = min(y0 + strip_rows, height)
+            h0, h1 = max(0, y0 - closing_halo), min(height, y1 + closing_halo)
+            strip = mosaic[rows[h0:h1]][:, columns]
+            mask = np.where(strip[..., 0] == 0, 0, 255).astype(np.uint8)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, closing_kernel)
+            writer.write(np.dstack((strip, mask))[y0 - h0 : y1 - h0])
+    finally:
+        writer.close()
+    return [width, height, crop_x, crop_y, "png"]
+
+def number_mosaic(mosaics_dir, source_name, mosaic_name, image_format):
+    # Renames a mosaic saved under a temporary name, with its mask for JPEG mosaics
+    source = mosaic_path(mosaics_dir, source_name, image_format)
+    target = mosaic_path(mosaics_dir, mosaic_name, image_format)
+    os.replace(source, target)
+    if image_format == "jpeg":
+        os.replace(mosaic_mask_path(source), mosaic_mask_path(target))
+
+class MosaicWriter():
+    # Saves mosaics on background threads so that encoding overlaps with stitching the next window.
+    # At most queue_size mosaics wait for a thread, which bounds the memory held by finished canvases.
+    # Mosaics are saved under the name of their window and numbered once saved, starting from
+    # first_number, so a mosaic that fails to save leaves no gap in the numbering.
+    def __init__(self, image_format = "png", compress_level = 6, threads = 2, queue_size = 2, checkpoint = None, first_number = 0):
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.checkpoint = checkpoint
+        self.executor = ThreadPoolExecutor(max_workers = threads)
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+        self.pending = []
+        self.rows = []
+        self.next_number = first_number
+
+    def save(self, mosaic, path, origin):
+        try:
+            return save_mosaic(mosaic, path, origin, self.image_format, self.compress_level)
+        finally:
+            self.slots.release()
+
+    def submit(self, mosaic, mosaics_dir, record, origin, window):
+        self.slots.acquire()
+        path = mosaic_path(mosaics_dir, f"window_{window}", self.image_format)
+        self.pending.append((mosaics_dir, window, record, self.executor.submit(self.save, mosaic, path, origin)))
+        self.collect()
+
+    def collect(self, wait = False):
+        # Takes the saved mosaics off the queue in window order, so the checkpoint only ever grows
+        # by the next mosaic of the run even when a later one finishes saving first
+        while self.pending and (wait or self.pending[0][3].done()):
+            mosaics_dir, window, record, future = self.pending.pop(0)
+            try:
+                mosaic_info = future.result()
+                number_mosaic(mosaics_dir, f"window_{window}", self.next_number, mosaic_info[-1])
+            except:
+                print(f"ERROR: Mosaic {self.next_number} could not be saved. Skipping...")
+                continue
+            row = [self.next_number] + record[1:] + mosaic_info
+            self.next_number += 1
+            self.rows.append(row)
+            if self.checkpoint is not None:
+                self.checkpoint.append(window, row)
+
+    def close(self):
+        # Waits for the queued mosaics and returns the rows of the ones that were saved
+        self.collect(wait = True)
+        self.executor.shutdown()
+        return self.rows
+
+class MosaicCheckpoint():
+    # Keeps mosaic_checkpoint.csv, the mosaic table of the current run together with the window
+    # each mosaic was stitched from. A row is appended as soon as its mosaic is on disk, so an
+    # interrupted run can be resumed from the first window that has no saved mosaic.
+    def __init__(self, mosaics_dir):
+        self.mosaics_dir = mosaics_dir
+        self.path = os.path.join(mosaics_dir, "mosaic_checkpoint.csv")
+
+    def reset(self, rows = ()):
+        with open(self.path, 'w') as file:
+            file.write(",".join(["window"] + mosaic_columns) + "\n")
+        for row in rows:
+            self.append(row[0], row[1:])
+
+    def append(self, window, row):
+        with open(self.path, 'a') as file:
+            file.write(",".join(str(value) for value in [window] + row) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def resume(self, windows):
+        # Returns the rows of the mosaics that can be kept and the window to continue from. Rows
+        # are kept up to the first one whose window no longer matches the planned frames or whose
+        # image is missing, and the checkpoint is cut back to them. Mosaics the interrupted run left
+        # under the temporary name of their window are removed, since those windows are redone.
+        for file_name in os.listdir(self.mosaics_dir):
+            if re.fullmatch(r"window_\d+(_mask\.png|\.png|\.webp|\.jpg)", file_name):
+                os.remove(os.path.join(self.mosaics_dir, file_name))
+        rows = []
+        try:
+            checkpoint = pd.read_csv(self.path)
+        except:
+            checkpoint = pd.DataFrame(columns = ["window"] + mosaic_columns)
+        for entry in checkpoint.itertuples(index = False):
+            window = windows[entry.window] if 0 <= entry.window < len(windows) else None
+            if window is None:
+                break
+            frame_numbers = window["frames"]["frame_number"]
+            if frame_numbers[0] != entry.first_frame or frame_numbers[-1] != entry.last_frame:
+                break
+            if not os.path.exists(mosaic_path(self.mosaics_dir, entry.mosaic_number, entry.image_format)):
+                break
+            rows.append([int(entry.window)] + list(entry)[1:])
+        self.reset(rows)
+        next_window = rows[-1][0] + 1 if rows else 0
+        return [row[1:] for row in rows], next_window
+
+def print_registration_counts(registration_counts):
+    total = sum(registration_counts.values())
+    if total > 0:
+        print(f"Registered {total} frames: {registration_counts['window']} within the search window, {registration_counts['pc']} by phase correlation, {registration_counts['cc']} ({100*registration_counts['cc']/total:.1f}%) by the cross-correlation fallback.")
+
+mosaic_columns = ["mosaic_number", "start_time_s", "end_time_s", "first_frame", "last_frame", "width_px", "height_px", "crop_x_px", "crop_y_px", "image_format"]
+mosaic_column_types = {column: (str if column == "image_format" else float if column.endswith("_s") else np.int64) for column in mosaic_columns}
+
+def mosaic_record(mosaic_counter, start_time, end_time, first_frame, last_frame):
+    # Start of a row of the mosaic table with the time span and frame range of the window. The
+    # save_mosaic info completes it with the pixel size of the saved image, the position of its top
+    # left corner relative to the first strip and its format.
+    return [mosaic_counter, start_time/1000, end_time/1000, int(first_frame), int(last_frame)]
+
+def save_mosaic_data(mosaics_dir, rows, mosaic_t, sync_vid_time):
+    mosaic_time_boundaries = pd.DataFrame(rows, columns = mosaic_columns)
+    save_table(os.path.join(mosaics_dir, "mosaic_time_boundaries.npz"), {column: mosaic_time_boundaries[column].to_numpy() for column in mosaic_columns}, mosaic_column_types)
+    # The CSV copy is kept for reading the time boundaries outside of CorStitch
+    mosaic_time_boundaries.to_csv(os.path.join(mosaics_dir, "mosaic_time_boundaries.csv"), index = False)
+    save_manifest(os.path.join(mosaics_dir, "mosaics_data.json"), {
+        "mosaic_time": mosaic_t,
+        "time": str(datetime.datetime.now()),
+        "sync_vid_time": sync_vid_time,
+        "num_mosaics": len(rows)
+    })
+
+def load_mosaic_data(mosaics_dir):
+    return load_manifest(os.path.join(mosaics_dir, "mosaics_data.json"), os.path.join(mosaics_dir, "mosaics_data.txt"))
+
+def load_mosaic_table(mosaics_dir):
+    path = os.path.join(mosaics_dir, "mosaic_time_boundaries.npz")
+    if os.path.exists(path):
+        return pd.DataFrame(load_table(path))
+    return pd.read_csv(os.path.join(mosaics_dir, "mosaic_time_boundaries.csv"))
+
+class FrameReader():
+    # Reads the frames listed in the frame scan data. Short gaps are skipped with grab(), which
+    # moves past frames without converting them into images. Gaps longer than seek_min_seconds
+    # are jumped with a seek, which the backend serves by decoding from the keyframe before the
+    # target, and the timestamp recorded by the frame scan confirms the frame it lands on. A video
+    # whose seek lands on the wrong frame once is read linearly from then on.
+    def __init__(self, vid_dir, verbose = True):
+        self.vid_dir = vid_dir
+        self.verbose = verbose
+        self.file_name = None
+        self.cam = None
+        self.unreliable_seeks = set()
+
+    def open(self, file_name):
+        if self.verbose and file_name != self.file_name:
+            print(f"Processing mosaics from {file_name}...")
+        self.release()
+        self.cam = cv2.VideoCapture(os.path.join(self.vid_dir, file_name))
+        self.file_name = file_name
+        self.length = int(self.cam.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cam.get(cv2.CAP_PROP_FPS)
+        self.frame_count = 0
+
+    def release(self):
+        if self.cam is not None:
+            self.cam.release()
+            self.cam = None
+
+    def seek(self, frame_location, timestamp_ms):
+        self.cam.set(cv2.CAP_PROP_POS_FRAMES, frame_location)
+        ret, frame = self.cam.read()
+        if ret and abs(self.cam.get(cv2.CAP_PROP_POS_MSEC) - timestamp_ms) <= 500/self.fps:
+            self.frame_count = frame_location + 1
+            return frame
+        # The seek landed on another frame, so the target is reached linearly from the start
+        self.unreliable_seeks.add(self.file_name)
+        self.open(self.file_name)
+        return None
+
+    def read(self, file_name, frame_location, timestamp_ms):
+        if file_name != self.file_name or frame_location < self.frame_count:
+            self.open(file_name)
+
+        if frame_location - self.frame_count > seek_min_seconds*self.fps and frame_location < self.length and file_name not in self.unreliable_seeks:
+            frame = self.seek(frame_location, timestamp_ms)
+            if frame is not None:
+                return frame
+
+        # Skip to the target frame without decoding the preceding frames into images
+        while self.frame_count < frame_location and self.frame_count < self.length:
+            self.cam.grab()
+            self.frame_count += 1
+
+        # Read the actual target frame
+        if self.frame_count == frame_location and self.frame_count < self.length:
+            ret, frame = self.cam.read()
+            self.frame_count += 1
+            if ret:
+                return frame
+        return None
+
+class MosaicWindowPlanner():
+    # Cuts frames into mosaic windows of window_length frames counted from starting_image, and
+    # works out the start and end time of each window from its first and last frame. Frame
+    # timestamps restart with every video, so whenever a window reaches a new video the end time
+    # of the previous mosaic is carried over as an offset. Windows are fed in order, either from
+    # the frame index or one at a time while the videos are decoded.
+    def __init__(self, starting_image, window_length):
+        self.starting_image = starting_image
+        self.window_length = window_length
+        self.current_filename = None
+        self.end_time = 0
+        self.accumulated_time = 0
+
+    def window(self, frame_number):
+        return (frame_number - self.starting_image)//self.window_length
+
+    def window_start(self, window):
+        return self.starting_image + window*self.window_length
+
+    def boundaries(self, last_frame):
+        # The last usable frame closes the final window
+        mosaic_boundaries = np.arange(self.starting_image, last_frame, self.window_length)
+        if mosaic_boundaries[-1] < last_frame:
+            mosaic_boundaries = np.append(mosaic_boundaries, last_frame)
+        return mosaic_boundaries
+
+    def reach_video(self, file_name):
+        if file_name != self.current_filename:
+            self.current_filename = file_name
+            self.accumulated_time = self.end_time
+
+    def start(self, file_name, timestamp_ms):
+        self.reach_video(file_name)
+        return timestamp_ms + self.accumulated_time
+
+    def finish(self, file_name, timestamp_ms):
+        self.reach_video(file_name)
+        self.end_time = timestamp_ms + self.accumulated_time
+        return self.end_time
+
+def plan_mosaic_windows(frame_index, planner, last_frame):
+    # Cuts the whole frame index into mosaic windows with a binary search per window boundary
+    mosaic_boundaries = planner.boundaries(last_frame)
+    window_starts = np.searchsorted(frame_index["frame_number"], mosaic_boundaries, side = "left")
+    video_files = frame_index["video_file"]
+    timestamps = frame_index["frame_timestamp"]
+
+    windows = []
+    for i in range(len(mosaic_boundaries)-1):
+        lo, hi = window_starts[i], window_starts[i+1]
+        if hi == lo:
+            windows.append(None)
+            continue
+        windows.append({
+            "frames": {column: values[lo:hi] for column, values in frame_index.items()},
+            "start_time": planner.start(video_files[lo], timestamps[lo]),
+            "end_time": planner.finish(video_files[hi-1], timestamps[hi-1]),
+        })
+    return windows
+
+def read_window(reader, frames, video_res):
+    num_frames = len(frames["frame_number"])
+    # The last frame of a window only closes it and is not stitched
+    for img_counter in range(num_frames - 1 if num_frames > 1 else 1):
+        frame = reader.read(frames["video_file"][img_counter], frames["frame_location"][img_counter], frames["frame_timestamp"][img_counter])
+        yield img_counter, None if frame is None else prepare_frame(frame, video_res)
+
+def stitch_window(reader, stitcher, frames, video_res):
+    # The window starts at its first readable frame, so frames are never registered against the
+    # last strip of a previous window
+    num_frames = len(frames["frame_number"])
+    started = False
+    for img_counter, frame in prefetch(read_window(reader, frames, video_res)):
+        if frame is None:
+            continue
+        if not started:
+            stitcher.start(frame, num_frames - img_counter)
+            started = True
+        else:
+            stitcher.add(frame)
+    if not started:
+        raise ValueError("None of the frames of the window could be read")
+    return stitcher.finish()
+
+def init_worker():
+    # Each worker process stitches its own window, so FFTs run single threaded
+    global NUM_THREADS
+    NUM_THREADS = 1
+
+def create_mosaic_window(args):
+    vid_dir, video_res, interval, registration_scale, search_radius, frames, path, image_format, compress_level = args
+    reader = FrameReader(vid_dir, verbose = False)
+    stitcher = MosaicStitcher(video_res, interval, registration_scale, search_radius, scratch_dir = os.path.dirname(path))
     try:
-        with open(os.path.join(mosaics_dir, f"frame_data.txt"), 'r') as file:
-            frame_data = file.readline()
-        fps = eval(frame_data)["fps"]
-        max_frame = eval(frame_data)["last_frame"]
-        interval = int(eval(frame_data)["frame_interval"])
+        mosaic_info = save_mosaic(stitch_window(reader, stitcher, frames, video_res), path, stitcher.origin, image_format, compress_level)
+        created = True
+    except:
+        mosaic_info = None
+        created = False
+    reader.release()
+    gc.collect()
+    return created, stitcher.registration_counts, mosaic_info
 
+def mosaic_creation(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res, workers = 1, registration_scale = 1, search_radius = 0, image_format = "png", compress_level = 6, resume = False):
 
-        strip_width = int(int(video_res[:-1])*sl_ratio/2-1)
-        sl = resolutions[video_res][0]
-        closing_kernel = np.ones((15,15),np.uint8)
-        yc, xc = resolutions[video_res][1]//2, resolutions[video_res][0]//2
+    try:
+        frame_data = load_frame_data(mosaics_dir)
+        fps = frame_data["fps"]
+        max_frame = frame_data["last_frame"]
+        interval = int(frame_data["frame_interval"])
+        stitcher = MosaicStitcher(video_res, interval, registration_scale, search_radius, scratch_dir = mosaics_dir)
         
     except:
         print("ERROR: Frame data could not be found. Process will abort in 60 seconds. You can close this window now.")
@@ -309,152 +1199,758 @@ def mosaic_creation(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res):
 
     starting_image = int(sync_vid_time*fps)
 
-    frame_data = pd.read_csv(os.path.join(mosaics_dir, "frame_scan_data.csv"))
-    img_ids = frame_data["frame_number"].to_list()
-    mosaic_boundaries = np.arange(starting_image, max_frame, int(round(fps*mosaic_t)))
-    if mosaic_boundaries[-1] < max_frame:
-        mosaic_boundaries = np.append(mosaic_boundaries, max_frame)
+    frame_index = load_frame_index(mosaics_dir)
+    windows = plan_mosaic_windows(frame_index, MosaicWindowPlanner(starting_image, int(round(fps*mosaic_t))), max_frame)
 
-    upper_threshold = 0.2*sl
-    stitching_threshold = 0.5*sl
-    mosaic_counter = 0
-    current_filename = None
-    frame_count = 0
-    end_time = 0
-    accumulated_time = 0
-    mosaic_time_boundaries = pd.DataFrame(columns = ["mosaic_number", "start_time_s", "end_time_s"])
-
-
-    with alive_bar(len(mosaic_boundaries)-1, title = f"Creating mosaics...") as bar:
-        for i in range(len(mosaic_boundaries)-1):
-            idset = [x for x in img_ids if x >= mosaic_boundaries[i] and x < mosaic_boundaries[i+1]]
-            left_border = 0
-            right_border = sl
-
-            for img_counter in range(len(idset)):
-                file_name = frame_data.loc[frame_data.frame_number == idset[img_counter], "video_file"].values[0]
-                current_frame = frame_data.loc[frame_data.frame_number == idset[img_counter], "frame_location"].values[0]
-
-                if file_name != current_filename:
-                    current_filename = file_name
-                    try:
-                        cam.release()
-                        cv2.destroyAllWindows()
-                        gc.collect()
-                    except:
-                        pass
-                    print(f"Processing mosaics from {current_filename}...")
-                    cam = cv2.VideoCapture(os.path.join(vid_dir, current_filename))
-                    property_id = int(cv2.CAP_PROP_FRAME_COUNT)
-                    length = int(cam.get(property_id))
-                    frame_count = 0
-                    accumulated_time = end_time
-
-                if frame_count >= length:
+    # Each saved mosaic is checkpointed right away. When resuming, the mosaics already on disk are
+    # kept and stitching starts at the first unfinished window, which the reader seeks straight to.
+    checkpoint = MosaicCheckpoint(mosaics_dir)
+    if resume:
+        mosaic_time_boundaries, first_window = checkpoint.resume(windows)
+        if mosaic_time_boundaries:
+            print(f"Resuming after mosaic {mosaic_time_boundaries[-1][0]}...")
+    else:
+        checkpoint.reset()
+        mosaic_time_boundaries, first_window = [], 0
+    mosaic_counter = mosaic_time_boundaries[-1][0] + 1 if mosaic_time_boundaries else 0
+
+    if workers > 1:
+        # Windows are stitched independently, each worker with its own capture seeked to its window.
+        # Results come back in window order so mosaics keep the numbering of a sequential run.
+        executor = ProcessPoolExecutor(max_workers = workers, initializer = init_worker)
+        jobs = executor.map(create_mosaic_window, [(vid_dir, video_res, interval, registration_scale, search_radius, window["frames"], mosaic_path(mosaics_dir, f"window_{i}", image_format), image_format, compress_level) for i, window in enumerate(windows) if window is not None and i >= first_window])
+    else:
+        reader = FrameReader(vid_dir)
+        writer = MosaicWriter(image_format, compress_level, checkpoint = checkpoint, first_number = mosaic_counter)
+
+    with alive_bar(len(windows), title = f"Creating mosaics...") as bar:
+        for i, window in enumerate(windows):
+            if i < first_window:
+                bar()
+                continue
+            if window is None:
+                print(f"ERROR: Mosaic {mosaic_counter} could not be created. Skipping...")
+                continue
+            frame_numbers = window["frames"]["frame_number"]
+            record = mosaic_record(mosaic_counter, window["start_time"], window["end_time"], frame_numbers[0], frame_numbers[-1])
+
+            if workers > 1:
+                try:
+                    created, registration_counts, mosaic_info = next(jobs)
+                except BrokenProcessPool:
+                    # A worker died, for example when it ran out of memory, which ends the pool. The
+                    # mosaics finished so far are still saved in the table below.
+                    print(f"ERROR: A mosaic worker stopped unexpectedly at mosaic {mosaic_counter}. The remaining mosaics were not created.")
                     break
+                for method in registration_counts:
+                    stitcher.registration_counts[method] += registration_counts[method]
+                if created:
+                    number_mosaic(mosaics_dir, f"window_{i}", mosaic_counter, mosaic_info[-1])
+                    mosaic_time_boundaries.append(record + mosaic_info)
+                    checkpoint.append(i, record + mosaic_info)
+            else:
+                try:
+                    mosaic = stitch_window(reader, stitcher, window["frames"], video_res)
+                    writer.submit(mosaic, mosaics_dir, record, stitcher.origin, i)
+                    del(mosaic)
+                    created = True
+                except:
+                    created = False
+                gc.collect()
 
-                # Seek to the target frame by skipping preceding frames
-                while frame_count < current_frame and frame_count < length:
-                    ret, frame = cam.read()
-                    frame_count += 1
-                    if not ret:
-                        if frame_count >= length:
-                            break
-
-                # Read the actual target frame
-                if frame_count == current_frame and frame_count < length:
-                    ret, frame = cam.read()
-                    frame_count += 1
-                    if ret:
-                        frame = cv2.resize(frame, dsize = resolutions[video_res], interpolation = cv2.INTER_AREA)
-                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            
-                        if img_counter == 0:
-                            start_time = float(frame_data.loc[frame_data.frame_number == idset[img_counter], "frame_timestamp"].values[0]) + accumulated_time
-                            img = frame
-                            strip1 = img[yc - strip_width : yc + strip_width + 1]
-                            mosaic = strip1
-
-                            # Padding
-                            current_x = int(sl*1.5)
-                            current_y = int(0.25*strip_width*len(idset))*interval
-                            mosaic = cv2.copyMakeBorder(mosaic, current_y, 0, current_x, current_x, cv2.BORDER_CONSTANT)
-                            left_border = 0
-                            right_border = mosaic.shape[1]
-                            
-                        
-                        elif img_counter < len(idset)-1:
-                            strip2 = frame[yc - strip_width : yc + strip_width + 1]
-                            try:
-                                py, px, reg_stats  = matching(np.ascontiguousarray(strip2[...,1]), np.ascontiguousarray(strip1[...,1]), strip_width, xc, upper_threshold)
-                            except:
-                                print("Matching failed. Skipping frame...")
-                                continue
-                            if np.sqrt((py - strip_width)**2 + (px-xc)**2) > stitching_threshold:
-                                continue
-
-                            y_offset = py - strip_width
-                            if y_offset <= 0:
-                                x_offset = px - xc
-                                current_x += x_offset 
-                                current_y += y_offset
-                                mstrip = strip2
-
-                                if idset[img_counter + 1] is None:
-                                    continue
-
-                                if current_y < 0:
-                                    mosaic = cv2.copyMakeBorder(mosaic, abs(current_y), 0, 0, 0, cv2.BORDER_CONSTANT)
-                                    current_y = 0
-
-                                if current_x < left_border:
-                                    mosaic = cv2.copyMakeBorder(mosaic,0, 0, -(current_x - left_border), 0, cv2.BORDER_CONSTANT) 
-                                    left_border = current_x
-                                elif current_x + sl > right_border:
-                                    mosaic = cv2.copyMakeBorder(mosaic,0, 0, 0, current_x + sl - right_border, cv2.BORDER_CONSTANT) 
-                                    right_border = current_x + sl 
-                                
-                                mosaic[current_y:current_y + strip_width*2+1,current_x - left_border : sl + current_x - left_border] = mstrip
-
-                                strip1 = strip2
-            try:
-                end_time = float(frame_data.loc[frame_data.frame_number == idset[img_counter], "frame_timestamp"].values[0]) + accumulated_time
-                non_black_rows = np.any(mosaic != [0, 0, 0], axis=(1, 2))
-                non_black_columns = np.any(mosaic != [0, 0, 0], axis=(0, 2))
-                mosaic = mosaic[non_black_rows, :]
-                mosaic = mosaic[:, non_black_columns]
-                mask = np.ones((mosaic.shape[0:2]))*255
-                black_region = mosaic == [0,0,0]
-                mask[black_region[...,0]] = 0
-                mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, closing_kernel)
-                mask = mask.astype(np.uint8)
-                mosaic = Image.fromarray(mosaic.astype(np.uint8)).convert('RGB')
-                mask = Image.fromarray(mask.astype(np.uint8)).convert('L')
-                mosaic.putalpha(mask)
-                mosaic.save(os.path.join(mosaics_dir, f"{mosaic_counter}.png"), "PNG")
-            except:
+            if not created:
                 print(f"ERROR: Mosaic {mosaic_counter} could not be created. Skipping...")
                 continue
-            del(mosaic)
-            del(mask)
-            gc.collect()
-            mosaic_time_boundaries.loc[len(mosaic_time_boundaries)] = [mosaic_counter, start_time/1000, end_time/1000]
 
             mosaic_counter+=1
             bar()
-    mosaic_time_boundaries.to_csv(os.path.join(mosaics_dir, "mosaic_time_boundaries.csv"), index = False)
-    mosaic_meta_data = {
-        "mosaic_time" : mosaic_t,
-        "time": str(datetime.datetime.now()),
-        "sync_vid_time": sync_vid_time,
-        "num_mosaics": mosaic_counter
-    }
-    with open(os.path.join(mosaics_dir,f"mosaics_data.txt"), 'w') as file:
-        file.write(str(mosaic_meta_data))
 
+    if workers > 1:
+        executor.shutdown()
+    else:
+        reader.release()
+        mosaic_time_boundaries += writer.close()
+    print_registration_counts(stitcher.registration_counts)
+    save_mosaic_data(mosaics_dir, mosaic_time_boundaries, mosaic_t, sync_vid_time)
+
+def scan_and_mosaic(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res, frame_interval, registration_scale = 1, search_radius = 0, image_format = "png", compress_level = 6):
+    # Single pass over the videos: every decoded frame is recorded in the frame scan data and,
+    # when it belongs to a mosaic window, handed straight to the stitcher.
+    video_files = get_video_files(vid_dir)
+    lengths = []
+    all_fps = []
+    for file_name in video_files:
+        cam = cv2.VideoCapture(os.path.join(vid_dir, file_name))
+        lengths.append(int(cam.get(cv2.CAP_PROP_FRAME_COUNT)))
+        all_fps.append(cam.get(cv2.CAP_PROP_FPS))
+        cam.release()
+    fps = np.mean(all_fps)
+    total_frames = int(np.sum(lengths))
+    # Every frame also goes into the per-video frame index cache used by later frame scans
+    signatures = {file_name: video_signature(os.path.join(vid_dir, file_name)) for file_name in video_files}
+    frame_indexes = {file_name: ([], []) for file_name in video_files}
+
+    planner = MosaicWindowPlanner(int(sync_vid_time*fps), int(round(fps*mosaic_t)))
+    stitcher = MosaicStitcher(video_res, frame_interval, registration_scale, search_radius, scratch_dir = mosaics_dir)
+    checkpoint = MosaicCheckpoint(mosaics_dir)
+    checkpoint.reset()
+    writer = MosaicWriter(image_format, compress_level, checkpoint = checkpoint)
+
+    rows = []
+    mosaic_counter = 0
+    current_window = None
+    current_filename = None
+
+    # The last usable frame closes the final window and is never stitched, so each sampled frame
+    # is held back until the next one arrives. Within a window, the latest frame is kept pending
+    # since the last frame of every window is not stitched either.
+    held = None
+    pending = None
+    last_timestamp = None
+
+    def finish_window():
+        nonlocal mosaic_counter
+        try:
+            end_time = planner.finish(current_filename, last_timestamp)
+            mosaic = stitcher.finish()
+            writer.submit(mosaic, mosaics_dir, mosaic_record(mosaic_counter, start_time, end_time, first_frame, last_frame), stitcher.origin, current_window)
+            del(mosaic)
+        except:
+            print(f"ERROR: Mosaic {mosaic_counter} could not be created. Skipping...")
+            return
+        gc.collect()
+        mosaic_counter += 1
+
+    def release(frame_number, file_name, timestamp_ms, frame):
+        nonlocal current_window, current_filename, start_time, first_frame, last_frame, pending, last_timestamp
+        if frame_number < planner.starting_image:
+            return
+        window = planner.window(frame_number)
+        if window != current_window and current_window is not None:
+            finish_window()
+            for empty_window in range(current_window + 1, window):
+                print(f"ERROR: Mosaic {mosaic_counter} could not be created. Skipping...")
+
+        if file_name != current_filename:
+            current_filename = file_name
+            print(f"Processing mosaics from {current_filename}...")
+
+        if window != current_window:
+            current_window = window
+            window_end = min(planner.window_start(window + 1), total_frames)
+            num_frames = int(np.ceil((window_end - frame_number)/frame_interval))
+            start_time = planner.start(file_name, timestamp_ms)
+            first_frame = frame_number
+            stitcher.start(frame, num_frames)
+            pending = None
+        else:
+            if pending is not None:
+                stitcher.add(pending)
+            pending = frame
+        last_timestamp = timestamp_ms
+        last_frame = frame_number
+
+    currentframe = 0
+    start_time = 0
+    first_frame = 0
+    last_frame = 0
+    with alive_bar(total_frames, title=f"Scanning frames and creating mosaics...") as bar:
+        # Frames are decoded and prepared on a separate thread while the previous ones are stitched
+        for file_name, frame_location, timestamp_ms, frame in prefetch(decode_videos(vid_dir, video_files, lengths, frame_interval, video_res)):
+            frame_indexes[file_name][0].append(frame_location)
+            frame_indexes[file_name][1].append(np.nan if timestamp_ms is None else timestamp_ms)
+            if frame is not None:
+                rows.append([
+                    currentframe,
+                    frame_location,
+                    file_name,
+                    timestamp_ms
+                ])
+                last_usable_frame = currentframe
+                if held is not None:
+                    release(*held)
+                held = (currentframe, file_name, timestamp_ms, frame)
+
+            currentframe += 1
+            bar()
+
+    if current_window is not None:
+        finish_window()
+    mosaic_time_boundaries = writer.close()
+    cv2.destroyAllWindows()
+    for file_name, file_fps in zip(video_files, all_fps):
+        save_video_index(mosaics_dir, file_name, signatures[file_name], *frame_indexes[file_name], file_fps)
+    print_registration_counts(stitcher.registration_counts)
+
+    save_frame_data(mosaics_dir, rows, fps, last_usable_frame, frame_interval)
+    save_mosaic_data(mosaics_dir, mosaic_time_boundaries, mosaic_t, sync_vid_time)
+    return last_usable_frame
+
+
+
+def track_bearing(lat_s, lon_s, lat_e, lon_e):
+    lon1 = lon_s * deg2rad
+    lon2 = lon_e * deg2rad
+    lat1 = lat_s * deg2rad
+    lat2 = lat_e * deg2rad
+
+    dlon = lon2 - lon1
+
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
 
+    brng = np.arctan2(y, x)  # radians, from North, clockwise
+    return (brng * rad2deg + 360) % 360
 
-def georeference(gps_data, data, vid_dir, mosaics_dir, kmz_dir, rect_mosaics_dir):
+def mosaic_footprints(starts, ends, lat_interp, lon_interp, heading_interp, depth_interp, width_m):
+    # Positions, headings, mean depths and ground overlay corners of all mosaics at once
+    mids = starts + (ends - starts)//2
+    footprints = pd.DataFrame({
+        "lat_s": lat_interp(starts), "lon_s": lon_interp(starts),
+        "lat_e": lat_interp(ends), "lon_e": lon_interp(ends),
+        "lat_m": lat_interp(mids), "lon_m": lon_interp(mids),
+        "heading_s": heading_interp(starts), "heading_e": heading_interp(ends), "heading": heading_interp(mids),
+    })
+    if depth_interp is not None:
+        footprints["depth"] = np.mean(depth_interp(np.linspace(starts, ends, 1000, axis = 1)), axis = 1)
+    else:
+        footprints["depth"] = 0
+
+    for side, lat, lon in (("s", footprints.lat_s, footprints.lon_s), ("e", footprints.lat_e, footprints.lon_e)):
+        perp = (footprints[f"heading_{side}"] + 90.0) * deg2rad
+        dx = 0.5 * width_m * np.sin(perp)
+        dy = 0.5 * width_m * np.cos(perp)
+
+        # meters → lat/lon
+        corners = {"s": ("tr", "tl"), "e": ("br", "bl")}[side]
+        footprints[f"{corners[0]}_lon"] = lon + (dx / (r_e * np.cos(lat * deg2rad))) * rad2deg
+        footprints[f"{corners[0]}_lat"] = lat + (dy / r_e) * rad2deg
+        footprints[f"{corners[1]}_lon"] = lon + (-dx / (r_e * np.cos(lat * deg2rad))) * rad2deg
+        footprints[f"{corners[1]}_lat"] = lat + (-dy / r_e) * rad2deg
+    return footprints
+
+def load_font(font_names, size):
+    for font_name in font_names:
+        try:
+            return ImageFont.truetype(font_name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+def draw_scalebar(draw, x, y, length_px, font, font_size):
+    # 1 m scale bar in a white box with its label under the bar, anchored at the lower left corner (x, y).
+    # Sizes follow the requested font size, since the bitmap fallback font has no size of its own.
+    pad = max(4, font_size//3)
+    bar_h = max(2, font_size//5)
+    label = "1 m"
+    left, top, right, bottom = draw.textbbox((0, 0), label, font = font)
+    box_w = max(length_px, right - left) + 2*pad
+    box_h = bar_h + (bottom - top) + 3*pad
+    draw.rectangle([x, y - box_h, x + box_w, y], fill = (255, 255, 255))
+    bar_x = x + (box_w - length_px)//2
+    draw.rectangle([bar_x, y - box_h + pad, bar_x + length_px, y - box_h + pad + bar_h], fill = (0, 0, 0))
+    draw.text((x + (box_w - (right - left))//2 - left, y - pad - bottom), label, font = font, fill = (0, 0, 0))
+
+def render_rectified_mosaic(args):
+    path, rect_mosaics_dir, mosaic_name, date, lat_m, lon_m, heading, depth, depth_status, px2m = args
+    img = load_mosaic(path)[:, :, 0:3]
+
+    img = imutils.rotate_bound(img, angle=heading)
+    non_black_rows = np.any(img != [0, 0, 0], axis=(1, 2))
+    non_black_columns = np.any(img != [0, 0, 0], axis=(0, 2))
+    img = img[non_black_rows, :]
+    img = img[:, non_black_columns]
+    rlpx, rwpx = img.shape[0], img.shape[1]
+    img_desc = '\n'.join((
+        r'mosaic no. %.0f' % (mosaic_name),
+        r'date: %s' % (date),
+        r'lat.: %.8f°' % (lat_m),
+        r'lon.: %.8f°' % (lon_m),
+        r'bearing: %.2f°' % (heading),
+        r'ave. depth: %.3f' % (depth),
+    ))
+
+    # The mosaic is drawn at its native resolution under a header with its description
+    font_size = max(14, rwpx//40)
+    title_font = load_font(["DejaVuSans.ttf", "arial.ttf", "Arial.ttf"], font_size)
+    margin = font_size//2
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox((0, 0), img_desc, font = title_font)
+    header_h = bottom + 2*margin
+
+    rendered = Image.new("RGB", (max(rwpx, right + 2*margin), header_h + rlpx), (255, 255, 255))
+    rendered.paste(Image.fromarray(img), (0, header_h))
+    draw = ImageDraw.Draw(rendered)
+    draw.multiline_text((margin, margin), img_desc, font = title_font, fill = (0, 0, 0))
+
+    if depth_status == 1:
+        scalebar_size = max(10, font_size*2//3)
+        scalebar_font = load_font(["DejaVuSansMono-Bold.ttf", "courbd.ttf", "Courier New Bold.ttf"], scalebar_size)
+        draw_scalebar(draw, margin, header_h + rlpx - margin, int(round(1/px2m)), scalebar_font, scalebar_size)
+
+    rendered.save(os.path.join(rect_mosaics_dir, f"{mosaic_name}.jpg"), "JPEG", quality = 90)
+    del(img)
+    del(rendered)
+    gc.collect()
+    return rlpx, rwpx
+
+class KmzWriter():
+    # Writes a KMZ as the mosaics come in: images go into the archive straight away, stored as they
+    # are since PNG and JPEG data is already compressed, and only the small KML fragments are kept
+    # until doc.kml is written when the archive is closed
+    def __init__(self, path):
+        self.kmz = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.features = []
+
+    def addfile(self, path):
+        name = f"files/{os.path.basename(path)}"
+        self.kmz.write(path, name, compress_type = zipfile.ZIP_STORED)
+        return name
+
+    def addicon(self, path):
+        # Ground overlay icons are embedded as RGBA PNGs: Google Earth does not read WebP icons,
+        # and a JPEG mosaic would lose the transparency kept in its mask
+        if os.path.splitext(path)[1] == mosaic_formats["png"]:
+            return self.addfile(path)
+        name = f"files/{os.path.splitext(os.path.basename(path))[0]}.png"
+        icon = io.BytesIO()
+        Image.fromarray(load_mosaic(path)).save(icon, "PNG")
+        self.kmz.writestr(name, icon.getvalue(), compress_type = zipfile.ZIP_STORED)
+        return name
+
+    def add_mosaic(self, mosaic_name, footprint, picpath, iconpath, rwpx, rlpx):
+        img_desc = f'<img src="{picpath}" alt="picture" width="{rwpx}" height="{rlpx}" align="left" />'
+        quad = " ".join(f"{lon},{lat},0.0" for lon, lat in [
+            (footprint.tl_lon, footprint.tl_lat),
+            (footprint.tr_lon, footprint.tr_lat),
+            (footprint.br_lon, footprint.br_lat),
+            (footprint.bl_lon, footprint.bl_lat)
+        ])
+        self.features.append(
+            f"""        <Placemark>
+            <name>{mosaic_name}</name>
+            <Style>
+                <BalloonStyle>
+                    <text>{escape(img_desc)}</text>
+                </BalloonStyle>
+            </Style>
+            <Point>
+                <coordinates>{footprint.lon_m},{footprint.lat_m},0.0</coordinates>
+            </Point>
+        </Placemark>
+        <GroundOverlay>
+            <name>{escape(os.path.basename(iconpath))}</name>
+            <description>{escape(os.path.basename(iconpath))}
+heading: {footprint.heading}</description>
+            <Icon>
+                <href>{escape(iconpath)}</href>
+            </Icon>
+            <gx:LatLonQuad>
+                <coordinates>{quad}</coordinates>
+            </gx:LatLonQuad>
+        </GroundOverlay>
+""")
+
+    def close(self):
+        doc = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+               '    <Document>\n' + "".join(self.features) + '    </Document>\n</kml>\n')
+        self.kmz.writestr("doc.kml", doc.encode("utf-8"))
+        self.kmz.close()
+        self.features = []
+
+def mosaic_pixel_sizes(mosaics_dir, mosaic_boundaries):
+    # Projects whose mosaic table predates the pixel size columns fall back to the PNG headers
+    if "width_px" in mosaic_boundaries.columns:
+        return mosaic_boundaries["width_px"].to_numpy(), mosaic_boundaries["height_px"].to_numpy()
+    sizes = np.array([get_imgdim(mosaic_path(mosaics_dir, int(i))) for i in mosaic_boundaries["mosaic_number"]])
+    return sizes[:, 1], sizes[:, 0]
+
+tile_size = 256
+tile_block_levels = 3
+
+def tile_bounds(z, x, y):
+    # Geodetic quadtree: level z splits the globe into 2^(z+1) x 2^z square tiles, counted from the north west
+    d = 180/2**z
+    west, north = -180 + x*d, 90 - y*d
+    return west, north - d, west + d, north
+
+def tile_range(z, west, south, east, north):
+    d = 180/2**z
+    return int((west + 180)//d), int((90 - north)//d), int((east + 180)//d), int((90 - south)//d)
+
+def footprint_quad(footprint):
+    # Corners of the gx:LatLonQuad, which go counterclockwise from the lower left corner of the image
+    return np.array([
+        [footprint.tl_lon, footprint.tl_lat],
+        [footprint.tr_lon, footprint.tr_lat],
+        [footprint.br_lon, footprint.br_lat],
+        [footprint.bl_lon, footprint.bl_lat]
+    ])
+
+def warp_mosaic(canvas, img, quad, west, north, deg_per_px):
+    # Draws an RGBA mosaic over the part of the canvas covered by its footprint. The pixel size is
+    # either one value for square pixels or a (longitude, latitude) pair.
+    dx, dy = np.broadcast_to(deg_per_px, 2)
+    h, w = img.shape[0:2]
+    src = np.float32([[0, h], [w, h], [w, 0], [0, 0]])
+    dst = np.float32(np.column_stack(((quad[:, 0] - west)/dx, (north - quad[:, 1])/dy)))
+    x0, y0 = np.maximum(np.floor(dst.min(axis = 0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(dst.max(axis = 0)).astype(int) + 1, [canvas.shape[1], canvas.shape[0]])
+    if x1 <= x0 or y1 <= y0:
+        return
+    M = cv2.getPerspectiveTransform(src, dst - np.float32([x0, y0]))
+    warped = cv2.warpPerspective(img, M, (int(x1 - x0), int(y1 - y0)), flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT, borderValue = 0)
+    alpha = warped[..., 3:]/255
+    region = canvas[y0:y1, x0:x1]
+    color = warped[..., 0:3]*alpha + region[..., 0:3]*(1 - alpha)
+    coverage = warped[..., 3:] + region[..., 3:]*(1 - alpha)
+    if region.dtype.kind in "ui":
+        # Rounded rather than truncated, which would darken every blended edge
+        color, coverage = np.round(color), np.round(coverage)
+    region[..., 0:3] = color
+    region[..., 3:] = coverage
+
+def downsample_tiles(canvas):
+    # Halves an RGBA canvas, averaging colours by their alpha so transparent pixels do not darken edges
+    alpha = canvas[..., 3]/255
+    size = (canvas.shape[1]//2, canvas.shape[0]//2)
+    color = cv2.resize(canvas[..., 0:3]*alpha[..., None], size, interpolation = cv2.INTER_AREA)
+    alpha = cv2.resize(alpha, size, interpolation = cv2.INTER_AREA)
+    color = color/np.maximum(alpha, 1e-6)[..., None]
+    return np.dstack((color, alpha*255))
+
+def tile_path(tiles_dir, z, x, y, ext):
+    return os.path.join(tiles_dir, str(z), str(x), f"{y}.{ext}")
+
+def save_tile(tiles_dir, z, x, y, tile):
+    path = tile_path(tiles_dir, z, x, y, "png")
+    if not np.any(tile[..., 3] > 0):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    Image.fromarray(np.clip(np.round(tile), 0, 255).astype(np.uint8), "RGBA").save(path, "PNG")
+    return True
+
+def remove_tile(tiles_dir, z, x, y):
+    for ext in ["png", "kml"]:
+        path = tile_path(tiles_dir, z, x, y, ext)
+        if os.path.exists(path):
+            os.remove(path)
+
+def region_kml(west, south, east, north, indent):
+    pad = " "*indent
+    return (f"{pad}<Region>\n"
+            f"{pad}    <LatLonAltBox><north>{north}</north><south>{south}</south><east>{east}</east><west>{west}</west></LatLonAltBox>\n"
+            f"{pad}    <Lod><minLodPixels>{tile_size//2}</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod>\n"
+            f"{pad}</Region>\n")
+
+def network_link_kml(z, x, y, href):
+    return ("        <NetworkLink>\n"
+            f"            <name>{z}/{x}/{y}</name>\n"
+            + region_kml(*tile_bounds(z, x, y), 12) +
+            f"            <Link><href>{href}</href><viewRefreshMode>onRegion</viewRefreshMode></Link>\n"
+            "        </NetworkLink>\n")
+
+def write_kml(path, body):
+    with open(path, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                   '    <Document>\n' + body + '    </Document>\n</kml>\n')
+
+def write_tile_kml(tiles_dir, z, x, y):
+    # Each tile shows its own image and links to the tiles under it, which viewers only load
+    # once the tile covers enough of the screen
+    west, south, east, north = tile_bounds(z, x, y)
+    body = region_kml(west, south, east, north, 8)
+    for cx in (2*x, 2*x + 1):
+        for cy in (2*y, 2*y + 1):
+            if os.path.exists(tile_path(tiles_dir, z + 1, cx, cy, "png")):
+                body += network_link_kml(z + 1, cx, cy, f"../../{z + 1}/{cx}/{cy}.kml")
+    body += ("        <GroundOverlay>\n"
+             f"            <drawOrder>{z}</drawOrder>\n"
+             f"            <Icon><href>{y}.png</href></Icon>\n"
+             f"            <LatLonBox><north>{north}</north><south>{south}</south><east>{east}</east><west>{west}</west></LatLonBox>\n"
+             "        </GroundOverlay>\n")
+    write_kml(tile_path(tiles_dir, z, x, y, "kml"), body)
+
+def block_tiles(z_max, zb, bx, by):
+    for z in range(z_max, zb - 1, -1):
+        n = 2**(z - zb)
+        for j in range(n):
+            for i in range(n):
+                yield z, bx*n + i, by*n + j
+
+def build_tile_block(args):
+    # Renders the leaf tiles of one block tile and every level down to the block tile itself
+    tiles_dir, z_max, zb, bx, by, sources = args
+    for z, x, y in block_tiles(z_max, zb, bx, by):
+        remove_tile(tiles_dir, z, x, y)
+
+    n = 2**(z_max - zb)
+    west, south, east, north = tile_bounds(zb, bx, by)
+    canvas = np.zeros((n*tile_size, n*tile_size, 4), np.float32)
+    for path, quad in sources:
+        img = load_mosaic(path)
+        warp_mosaic(canvas, img, np.array(quad), west, north, (east - west)/canvas.shape[1])
+        del(img)
+
+    for z in range(z_max, zb - 1, -1):
+        n = 2**(z - zb)
+        for j in range(n):
+            for i in range(n):
+                x, y = bx*n + i, by*n + j
+                if save_tile(tiles_dir, z, x, y, canvas[j*tile_size:(j + 1)*tile_size, i*tile_size:(i + 1)*tile_size]):
+                    write_tile_kml(tiles_dir, z, x, y)
+        if z > zb:
+            canvas = downsample_tiles(canvas)
+    gc.collect()
+    return bx, by
+
+def build_tile_pyramid(mosaics_dir, footprints, tiles_dir, workers = 1):
+    # Regionated KML super-overlay of all mosaics. Leaf tiles match the median mosaic resolution and
+    # are rendered in blocks of a few levels, in parallel. Blocks whose mosaics have not changed
+    # since the last run, according to the manifest, are kept as they are.
+    quads = [footprint_quad(footprint) for _, footprint in footprints.iterrows()]
+    corners = np.concatenate(quads)
+    west, south = corners.min(axis = 0)
+    east, north = corners.max(axis = 0)
+
+    deg_per_px = np.median(footprints["px2m"])/(r_e*deg2rad)
+    z_max = int(np.clip(np.ceil(np.log2(180/(tile_size*deg_per_px))), 0, 30))
+    z_min = int(np.clip(np.floor(np.log2(180/max(east - west, north - south))), 0, z_max))
+    zb = max(z_min, z_max - tile_block_levels)
+
+    manifest_path = os.path.join(tiles_dir, "tiles_manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    if manifest.get("levels") != [z_min, zb, z_max]:
+        # The tiling changed, so none of the previous tiles can be reused
+        for name in os.listdir(tiles_dir):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(tiles_dir, name))
+        manifest = {"blocks": {}}
+    previous_blocks = manifest["blocks"]
+
+    blocks = {}
+    for (i, footprint), quad in zip(footprints.iterrows(), quads):
+        path = mosaic_path(mosaics_dir, int(i), footprint.image_format)
+        stat = os.stat(path)
+        qx0, qy0, qx1, qy1 = tile_range(zb, *quad.min(axis = 0), *quad.max(axis = 0))
+        for bx in range(qx0, qx1 + 1):
+            for by in range(qy0, qy1 + 1):
+                blocks.setdefault(f"{bx}/{by}", []).append((path, quad.tolist(), stat.st_size, stat.st_mtime_ns))
+
+    signatures = {key: hashlib.sha1(json.dumps(sources).encode()).hexdigest() for key, sources in blocks.items()}
+    changed = [key for key in blocks if previous_blocks.get(key) != signatures[key]]
+    removed = [key for key in previous_blocks if key not in blocks]
+    for key in removed:
+        bx, by = map(int, key.split("/"))
+        for z, x, y in block_tiles(z_max, zb, bx, by):
+            remove_tile(tiles_dir, z, x, y)
+
+    jobs = []
+    for key in changed:
+        bx, by = map(int, key.split("/"))
+        jobs.append((tiles_dir, z_max, zb, bx, by, [(path, quad) for path, quad, _, _ in blocks[key]]))
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers = workers)
+        built = executor.map(build_tile_block, jobs)
+    else:
+        built = map(build_tile_block, jobs)
+
+    dirty = set()
+    with alive_bar(len(jobs), title = f"Building map tiles...") as bar:
+        for bx, by in built:
+            dirty.add((bx, by))
+            bar()
+    if workers > 1:
+        executor.shutdown()
+    for key in removed:
+        dirty.add(tuple(map(int, key.split("/"))))
+
+    # Levels above the blocks are small, so they are merged from their children here
+    for z in range(zb - 1, z_min - 1, -1):
+        dirty = {(x//2, y//2) for x, y in dirty}
+        for x, y in dirty:
+            remove_tile(tiles_dir, z, x, y)
+            canvas = np.zeros((2*tile_size, 2*tile_size, 4), np.float32)
+            for i in range(2):
+                for j in range(2):
+                    child = tile_path(tiles_dir, z + 1, 2*x + i, 2*y + j, "png")
+                    if os.path.exists(child):
+                        canvas[j*tile_size:(j + 1)*tile_size, i*tile_size:(i + 1)*tile_size] = np.array(Image.open(child))
+            if save_tile(tiles_dir, z, x, y, downsample_tiles(canvas)):
+                write_tile_kml(tiles_dir, z, x, y)
+
+    x0, y0, x1, y1 = tile_range(z_min, west, south, east, north)
+    body = ""
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            if os.path.exists(tile_path(tiles_dir, z_min, x, y, "png")):
+                body += network_link_kml(z_min, x, y, f"{z_min}/{x}/{y}.kml")
+    write_kml(os.path.join(tiles_dir, "doc.kml"), body)
+
+    with open(manifest_path, 'w') as file:
+        json.dump({"levels": [z_min, zb, z_max], "blocks": signatures}, file)
+
+def geotiff_tags(west, north, dx, dy):
+    # Georeferencing of a north-up EPSG:4326 raster: pixel size, the tie point of its north west corner
+    # and a GeoKey directory for a geographic model with pixel-is-area rasters
+    geokeys = [1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1, 2048, 0, 1, 4326]
+    return [
+        (33550, 'd', 3, (dx, dy, 0.0), True),
+        (33922, 'd', 6, (0.0, 0.0, 0.0, west, north, 0.0), True),
+        (34735, 'H', len(geokeys), geokeys, True),
+    ]
+
+def downsample_image(image, out, block = 1024):
+    # Halves an RGBA image into out one block at a time, so memory-mapped rasters are never read whole
+    # however wide or tall they are. Halving averages 2x2 pixels, so the blocks are independent.
+    for y in range(0, out.shape[0], block//2):
+        for x in range(0, out.shape[1], block//2):
+            h, w = min(block//2, out.shape[0] - y), min(block//2, out.shape[1] - x)
+            pixels = image[2*y : 2*(y + h), 2*x : 2*(x + w)].astype(np.float32)
+            out[y : y + h, x : x + w] = np.clip(np.round(downsample_tiles(pixels)), 0, 255)
+
+def write_geotiff(path, image, west, north, dx, dy):
+    # Internally tiled, zlib compressed RGBA GeoTIFF with its overviews as reduced resolution subfiles.
+    # Overviews of a memory-mapped image are memory-mapped as well and removed once written.
+    if tifffile is None:
+        raise ImportError("GeoTIFF output needs the tifffile package")
+    options = dict(photometric = 'rgb', extrasamples = ['unassalpha'], tile = (tile_size, tile_size), compression = 'zlib')
+    overviews = [image]
+    overview_paths = []
+    while max(overviews[-1].shape[0:2]) > tile_size and min(overviews[-1].shape[0:2]) >= 2:
+        shape = (overviews[-1].shape[0]//2, overviews[-1].shape[1]//2, 4)
+        if isinstance(image, np.memmap):
+            overview_paths.append(f"{path}.ovr{len(overview_paths)}")
+            overview = np.memmap(overview_paths[-1], dtype = np.uint8, mode = 'w+', shape = shape)
+        else:
+            overview = np.empty(shape, np.uint8)
+        downsample_image(overviews[-1], overview)
+        overviews.append(overview)
+        del(overview)
+
+    with tifffile.TiffWriter(path, bigtiff = image.nbytes > 2**31) as tif:
+        tif.write(image, extratags = geotiff_tags(west, north, dx, dy), **options)
+        for overview in overviews[1:]:
+            tif.write(overview, subfiletype = 1, **options)
+            del(overview)
+    del(overviews)
+    for overview_path in overview_paths:
+        os.remove(overview_path)
+
+def geotiff_pixel_size(px2m, lat):
+    # Degrees per pixel that keep the mosaic resolution, with square pixels on the ground
+    dy = px2m/(r_e*deg2rad)
+    return dy/np.cos(lat*deg2rad), dy
+
+def write_mosaic_geotiff(args):
+    path, geotiff_dir, mosaic_name, quad, px2m = args
+    img = load_mosaic(path)
+    west, south = quad.min(axis = 0)
+    east, north = quad.max(axis = 0)
+    dx, dy = geotiff_pixel_size(px2m, (north + south)/2)
+    canvas = np.zeros((int(np.ceil((north - south)/dy)), int(np.ceil((east - west)/dx)), 4), np.uint8)
+    warp_mosaic(canvas, img, quad, west, north, (dx, dy))
+    del(img)
+    write_geotiff(os.path.join(geotiff_dir, f"{mosaic_name}.tif"), canvas, west, north, dx, dy)
+    del(canvas)
+    gc.collect()
+
+ortho_chunk = 4096
+# Largest orthomosaic raster in pixels (4 GB of RGBA), which its memory-mapped file and the GeoTIFF are written at in full
+ortho_pixel_limit = 2**30
+
+def render_ortho_chunk(args):
+    # Draws the mosaics overlapping one chunk of the orthomosaic. Chunks do not overlap, so they can be
+    # written into the shared memory-mapped raster from separate processes.
+    raw_path, shape, y0, y1, x0, x1, west, north, dx, dy, sources = args
+    ortho = np.memmap(raw_path, dtype = np.uint8, mode = 'r+', shape = shape)
+    chunk = np.array(ortho[y0:y1, x0:x1])
+    for path, quad, scale in sources:
+        img = load_mosaic(path)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, int(img.shape[1]*scale)), max(1, int(img.shape[0]*scale))), interpolation = cv2.INTER_AREA)
+        warp_mosaic(chunk, img, quad, west + x0*dx, north - y0*dy, (dx, dy))
+        del(img)
+    ortho[y0:y1, x0:x1] = chunk
+    ortho.flush()
+    del(ortho, chunk)
+    gc.collect()
+
+def orthomosaic(mosaics_dir, ortho_dir, workers = 1, pixel_size = 0):
+    # Projects every georeferenced mosaic into one survey-wide raster on a local grid with square
+    # pixels of pixel_size metres (the median mosaic resolution when 0). The raster lives in a
+    # memory-mapped file and is rendered in chunks, so memory use does not grow with the survey.
+    if tifffile is None:
+        print("ERROR: The orthomosaic needs the tifffile package. Skipping...")
+        return
+    footprints = pd.read_csv(os.path.join(mosaics_dir, "mosaic_footprints.csv"))
+    quads = [footprint_quad(footprint) for _, footprint in footprints.iterrows()]
+    corners = np.concatenate(quads)
+    west, south = corners.min(axis = 0)
+    east, north = corners.max(axis = 0)
+    default_size = not pixel_size
+    if default_size:
+        pixel_size = np.median(footprints["px2m"])
+    dx, dy = geotiff_pixel_size(pixel_size, (north + south)/2)
+    num_pixels = (north - south)/dy*(east - west)/dx
+    if num_pixels > ortho_pixel_limit:
+        # The raster covers the bounding box of the survey, which is mostly empty for a diagonal
+        # transect, so the default resolution is coarsened to keep it within the limit
+        if not default_size:
+            print(f"ERROR: An orthomosaic at {1000*pixel_size:.2f} mm per pixel would have {num_pixels/1e9:.1f} billion pixels. Choose a coarser resolution. Skipping...")
+            return
+        pixel_size *= np.sqrt(num_pixels/ortho_pixel_limit)
+        dx, dy = geotiff_pixel_size(pixel_size, (north + south)/2)
+        print("The survey area is too large for an orthomosaic at the resolution of the mosaics. Using a coarser resolution...")
+    shape = (int(np.ceil((north - south)/dy)), int(np.ceil((east - west)/dx)), 4)
+    print(f"Orthomosaic size: {shape[1]} x {shape[0]} pixels at {100*pixel_size:.2f} cm per pixel")
+
+    raw_path = os.path.join(ortho_dir, "orthomosaic.raw")
+    ortho = np.memmap(raw_path, dtype = np.uint8, mode = 'w+', shape = shape)
+    del(ortho)
+
+    # Pixel bounding box of each footprint, for selecting the mosaics that overlap a chunk
+    quads_array = np.array(quads)
+    qx0, qx1 = (quads_array[..., 0].min(axis = 1) - west)/dx, (quads_array[..., 0].max(axis = 1) - west)/dx
+    qy0, qy1 = (north - quads_array[..., 1].max(axis = 1))/dy, (north - quads_array[..., 1].min(axis = 1))/dy
+    mosaic_sources = [(mosaic_path(mosaics_dir, int(footprint.mosaic_number), footprint.get("image_format", "png")), quad, footprint.px2m/pixel_size) for (_, footprint), quad in zip(footprints.iterrows(), quads)]
+
+    jobs = []
+    for y0 in range(0, shape[0], ortho_chunk):
+        for x0 in range(0, shape[1], ortho_chunk):
+            y1, x1 = min(y0 + ortho_chunk, shape[0]), min(x0 + ortho_chunk, shape[1])
+            overlapping = np.flatnonzero((qx1 >= x0) & (qx0 <= x1) & (qy1 >= y0) & (qy0 <= y1))
+            sources = [mosaic_sources[i] for i in overlapping]
+            if sources:
+                jobs.append((raw_path, shape, y0, y1, x0, x1, west, north, dx, dy, sources))
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers = workers)
+        rendered = executor.map(render_ortho_chunk, jobs)
+    else:
+        rendered = map(render_ortho_chunk, jobs)
+    with alive_bar(len(jobs), title = f"Building orthomosaic...") as bar:
+        for _ in rendered:
+            bar()
+    if workers > 1:
+        executor.shutdown()
+
+    print("Writing orthomosaic...")
+    ortho = np.memmap(raw_path, dtype = np.uint8, mode = 'r', shape = shape)
+    write_geotiff(os.path.join(ortho_dir, "orthomosaic.tif"), ortho, west, north, dx, dy)
+    del(ortho)
+    os.remove(raw_path)
+
+def georeference(gps_data, data, vid_dir, mosaics_dir, kmz_dir, rect_mosaics_dir, workers = 1, tiles_dir = None, geotiff_dir = None):
     utc_offset = data["utc_offset"]
     sync_UTC_time = str(data["sync_time"])
     sync_UTC_time = datetime.datetime.strptime(sync_UTC_time,'%H:%M:%S')
@@ -489,9 +1985,7 @@ def georeference(gps_data, data, vid_dir, mosaics_dir, kmz_dir, rect_mosaics_dir
         ave_depth = np.mean(gps_data.dep_m)
 
     print("Georeferencing images...")
-    with open(os.path.join(mosaics_dir, "mosaics_data.txt"), 'r') as file:
-        mosaic_data = file.readline()
-    mosaic_data = eval(mosaic_data)
+    mosaic_data = load_mosaic_data(mosaics_dir)
     num_mosaics = mosaic_data["num_mosaics"]
 
     if num_mosaics == 0:
@@ -500,157 +1994,76 @@ def georeference(gps_data, data, vid_dir, mosaics_dir, kmz_dir, rect_mosaics_dir
         kmz_limit = 100
         img_counter = 0
         kmz_counter = 0
-        kml = simplekml.Kml()
-        depth = 0
+        kml = None
         if depth_status == 0:
             width_m = 5
-        mosaic_boundaries = pd.read_csv(os.path.join(mosaics_dir, "mosaic_time_boundaries.csv"))
+        mosaic_boundaries = load_mosaic_table(mosaics_dir)
         start_times = mosaic_boundaries['start_time_s'].tolist()
         end_times = mosaic_boundaries['end_time_s'].tolist()
         time_floor = start_times[0]
         time_sync = sync_UTC_time - time_floor
 
-
+        starts = np.array(start_times) + time_sync
+        ends = np.array(end_times) + time_sync
         if heading_status == 0:
-            all_headings = []
-            for i in range(len(mosaic_boundaries)):
-                start = start_times[i]+ time_sync
-                end = end_times[i]+ time_sync
-                mid = start + (end-start)//2
-
-                lat_s = lat_interp(start)
-                lon_s = lon_interp(start)
-                lat_e = lat_interp(end)
-                lon_e = lon_interp(end)
-
-                lon1 = lon_s * deg2rad
-                lon2 = lon_e * deg2rad
-                lat1 = lat_s * deg2rad
-                lat2 = lat_e * deg2rad
-
-                dlon = lon2 - lon1
-
-                y = np.sin(dlon) * np.cos(lat2)
-                x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
-
-                brng = np.arctan2(y, x)  # radians, from North, clockwise
-                heading = (brng * rad2deg + 360) % 360
-
-                all_headings.append(heading)
-            all_headings = np.array(all_headings)
+            all_headings = track_bearing(lat_interp(starts), lon_interp(starts), lat_interp(ends), lon_interp(ends))
             heading_interp = sp.interpolate.interp1d(mosaic_boundaries['start_time_s']+ time_sync, all_headings, kind='linear', fill_value="extrapolate", bounds_error=False)
         if heading_status == 1:
             heading_interp = sp.interpolate.interp1d(gps_data.conv_time, gps_data.instr_heading, kind='linear', fill_value="extrapolate", bounds_error=False)
 
-        with alive_bar(len(mosaic_boundaries), title = f"Georeferencing mosaics...") as bar:
-            for i in range(len(mosaic_boundaries)):
-                    
-                start = start_times[i] + time_sync
-                end = end_times[i] + time_sync
-                mid = start + (end-start)//2
-
-                mosaic_name = int(i)
-                icon_path = os.path.join(mosaics_dir, f"{mosaic_name}.png")
-                lpx, wpx = get_imgdim(icon_path)
-
-                lat_s = lat_interp(start)
-                lon_s = lon_interp(start)
-                lat_e = lat_interp(end)
-                lon_e = lon_interp(end)
-                lat_m = lat_interp(mid)
-                lon_m = lon_interp(mid)
-                heading_s = heading_interp(start)
-                heading_e = heading_interp(end)
-                heading = heading_interp(mid)
-
-                if depth_status == 1:
-                    depth = np.mean(depth_interp(np.linspace(start, end, 1000)))
-                    width_m = 1.55948 * ave_depth
-                    px2m = width_m / wpx
-                    scalebar = ScaleBar(dx=px2m,
-                                        units='m',
-                                        fixed_value=1,
-                                        fixed_units='m',
-                                        location="lower left",
-                                        font_properties={'family': 'monospace',
-                                                        'weight': 'semibold',
-                                                        'size': 20})
-                    
-                img = np.array(Image.open(os.path.join(mosaics_dir, f"{mosaic_name}.png")))[:, :, 0:3]
-                img = imutils.rotate_bound(img, angle=heading)
-                non_black_rows = np.any(img != [0, 0, 0], axis=(1, 2))
-                non_black_columns = np.any(img != [0, 0, 0], axis=(0, 2))
-                img = img[non_black_rows, :]
-                img = img[:, non_black_columns]
-                rlpx, rwpx = img.shape[0], img.shape[1]
-                fig, ax = plt.subplots(figsize=(20, 20))
-                img_desc = '\n'.join((
-                    r'mosaic no. %.0f' % (mosaic_name),
-                    r'date: %s' % (date),
-                    r'lat.: %.8f°' % (lat_m),
-                    r'lon.: %.8f°' % (lon_m),
-                    r'bearing: %.2f°' % (heading),
-                    r'ave. depth: %.3f' % (depth),
-                ))
-
-                ax.imshow(img)
-                ax.set_title(img_desc, loc="left", fontsize=30)
-                plt.gca().set_aspect('equal', adjustable='box')
-                if depth_status == 1:
-                    plt.gca().add_artist(scalebar)
-                ax.set_axis_off()
-
-                fig.savefig(os.path.join(rect_mosaics_dir, f"{mosaic_name}.jpg"), bbox_inches='tight')
-                plt.close('all')
-                gc.collect()
-
-                point = kml.newpoint(name=f"{mosaic_name}", coords=[(lon_m, lat_m)])
-                picpath = kml.addfile(os.path.join(rect_mosaics_dir, f"{mosaic_name}.jpg"))
-                img_desc = f'<img src="{picpath}" alt="picture" width="{rwpx}" height="{rlpx}" align="left" />'
-                point.style.balloonstyle.text = img_desc
-
-                ground = kml.newgroundoverlay(name=f"{mosaic_name}.png")
-                ground.icon.href = icon_path
-                ground.description = f"{mosaic_name}.png\nheading: {heading}"
-
-                perp_s = (heading_s + 90.0) * deg2rad
-                perp_e = (heading_e + 90.0) * deg2rad
-
-                dxs = 0.5 * width_m * np.sin(perp_s)   
-                dys = 0.5 * width_m * np.cos(perp_s)   
-                dx2s = -dxs
-                dy2s = -dys
-
-                dxe = 0.5 * width_m * np.sin(perp_e)
-                dye = 0.5 * width_m * np.cos(perp_e)
-                dx2e = -dxe
-                dy2e = -dye
+        if depth_status == 1:
+            width_m = 1.55948 * ave_depth
+        else:
+            depth_interp = None
+        footprints = mosaic_footprints(starts, ends, lat_interp, lon_interp, heading_interp, depth_interp, width_m)
+        footprints["width_px"], footprints["height_px"] = mosaic_pixel_sizes(mosaics_dir, mosaic_boundaries)
+        footprints["px2m"] = width_m / footprints["width_px"]
+        footprints.index = mosaic_boundaries["mosaic_number"].to_numpy()
+        footprints["image_format"] = mosaic_boundaries["image_format"].to_numpy() if "image_format" in mosaic_boundaries.columns else "png"
+        footprints.to_csv(os.path.join(mosaics_dir, "mosaic_footprints.csv"), index_label = "mosaic_number")
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers = workers)
+            pool_map = executor.map
+        else:
+            pool_map = map
 
-                # meters → lat/lon
-                tr_lon = lon_s + (dxs / (r_e * np.cos(lat_s * deg2rad))) * rad2deg
-                tr_lat = lat_s + (dys / r_e) * rad2deg
+        if kmz_dir is not None:
+            render_jobs = [(mosaic_path(mosaics_dir, int(i), footprint.image_format), rect_mosaics_dir, int(i), date, footprint.lat_m, footprint.lon_m, footprint.heading, footprint.depth, depth_status, footprint.px2m) for i, footprint in footprints.iterrows()]
 
-                tl_lon = lon_s + (dx2s / (r_e * np.cos(lat_s * deg2rad))) * rad2deg
-                tl_lat = lat_s + (dy2s / r_e) * rad2deg
+            # Rectified mosaics are rendered independently, while the KML is assembled in mosaic order
+            rendered = pool_map(render_rectified_mosaic, render_jobs)
+            with alive_bar(len(mosaic_boundaries), title = f"Georeferencing mosaics...") as bar:
+                for i, (rlpx, rwpx) in enumerate(rendered):
+                    footprint = footprints.iloc[i]
+                    mosaic_name = int(footprints.index[i])
+                    if kml is None:
+                        kml = KmzWriter(os.path.join(kmz_dir, f"{kmz_counter}.kmz"))
 
-                br_lon = lon_e + (dxe / (r_e * np.cos(lat_e * deg2rad))) * rad2deg
-                br_lat = lat_e + (dye / r_e) * rad2deg
+                    picpath = kml.addfile(os.path.join(rect_mosaics_dir, f"{mosaic_name}.jpg"))
+                    icon_path = kml.addicon(mosaic_path(mosaics_dir, mosaic_name, footprint.image_format))
+                    kml.add_mosaic(mosaic_name, footprint, picpath, icon_path, rwpx, rlpx)
 
-                bl_lon = lon_e + (dx2e / (r_e * np.cos(lat_e * deg2rad))) * rad2deg
-                bl_lat = lat_e + (dy2e / r_e) * rad2deg
+                    img_counter += 1
+                    bar()
+                    if img_counter % kmz_limit == 0:
+                        kml.close()
+                        kml = None
+                        kmz_counter += 1
+                if kml is not None:
+                    kml.close()
+
+        if geotiff_dir is not None and tifffile is None:
+            print("ERROR: GeoTIFF output needs the tifffile package. Skipping...")
+        elif geotiff_dir is not None:
+            geotiff_jobs = [(mosaic_path(mosaics_dir, int(i), footprint.image_format), geotiff_dir, int(i), footprint_quad(footprint), footprint.px2m) for i, footprint in footprints.iterrows()]
+            with alive_bar(len(geotiff_jobs), title = f"Writing GeoTIFFs...") as bar:
+                for _ in pool_map(write_mosaic_geotiff, geotiff_jobs):
+                    bar()
 
-                ground.gxlatlonquad.coords = [
-                    (tl_lon, tl_lat),
-                    (tr_lon, tr_lat),
-                    (br_lon, br_lat),
-                    (bl_lon, bl_lat)
-                ]
+        if workers > 1:
+            executor.shutdown()
 
-                img_counter += 1
-                bar()
-                if img_counter % kmz_limit == 0:
-                    kml.savekmz(os.path.join(kmz_dir, f"{kmz_counter}.kmz"))
-                    kml = simplekml.Kml()
-                    kmz_counter += 1
-            if img_counter % kmz_limit != 0:
-                kml.savekmz(os.path.join(kmz_dir, f"{kmz_counter}.kmz"))
+        if tiles_dir is not None:
+            print("Building map tiles...")
+            build_tile_pyramid(mosaics_dir, footprints, tiles_dir, workers)
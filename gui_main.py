@@ -10,8 +10,8 @@ from PyQt5.QtWidgets import (
     QTimeEdit, QSizePolicy, QGridLayout, QFrame, QToolButton, QToolTip, QDialog
 )
 import datetime
-from PyQt5.QtCore import QDate, Qt, QTime
-from PyQt5.QtGui import QIntValidator
+from PyQt5.QtCore import QDate, Qt, QTime, QLocale
+from PyQt5.QtGui import QIntValidator, QDoubleValidator
 import sys
 import numpy as np
 import gc
@@ -19,12 +19,12 @@ import scipy as sp
 import os
 import time
 import copy
+import multiprocessing
 import pandas as pd
 from PIL import Image
-import matplotlib
-matplotlib.use('Agg', force = True)
-from gui_init import HMS2Conv, georeference, mosaic_creation, scan_frames, get_imgdim, GPSdata
+from gui_init import HMS2Conv, georeference, orthomosaic, mosaic_creation, scan_frames, scan_and_mosaic, get_imgdim, GPSdata
 valid_video_types = ['.mp4', '.avi', '.mov', '.mkv']
+mosaic_format_options = {"PNG": "png", "WebP lossless": "webp", "JPEG and mask": "jpeg"}
 r_e = 6378.137*1000
 deg2rad = np.pi/180
 rad2deg = 180/np.pi
@@ -160,6 +160,38 @@ class MainWindow(QWidget):
         frame_interval_layout.addWidget(frame_interval_info)
         frame_interval_widget.setLayout(frame_interval_layout)
         frame_form.addRow(frame_interval_label, frame_interval_widget)
+
+        # Decode every frame while scanning instead of reading the container metadata
+        self.full_decode = QCheckBox("Decode every frame")
+        full_decode_info = QLabel(self.info_icon_html)
+        full_decode_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">By default, frames are scanned from the timestamps stored in the video files, which takes seconds. Videos with unreadable sections are then scanned again frame by frame. Check this if your videos have damaged frames that still show up in the mosaics, so that every frame is decoded and checked.</div>'
+        )
+        full_decode_widget = QWidget()
+        full_decode_layout = QHBoxLayout()
+        full_decode_layout.setContentsMargins(0, 0, 0, 0)
+        full_decode_layout.addWidget(self.full_decode)
+        full_decode_layout.addWidget(full_decode_info)
+        full_decode_widget.setLayout(full_decode_layout)
+        frame_form.addRow("Full decoding:", full_decode_widget)
+
+        # Number of worker processes (natural numbers only)
+        self.scan_workers = QLineEdit()
+        self.scan_workers.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.scan_workers.setText("1")
+        self.scan_workers.setValidator(QIntValidator(1, os.cpu_count(), self))
+
+        scan_workers_info = QLabel(self.info_icon_html)
+        scan_workers_info.setToolTip(
+            f'<div style="white-space:pre-line; width:240px;">This sets how many videos are scanned at the same time, each in its own process. Your computer has {os.cpu_count()} cores. Videos that were already scanned are not scanned again. To scan the videos one at a time, set this to 1. With 1 scan worker and 1 mosaic worker, frames are scanned and mosaics created in a single pass over the videos.</div>'
+        )
+        scan_workers_widget = QWidget()
+        scan_workers_layout = QHBoxLayout()
+        scan_workers_layout.setContentsMargins(0, 0, 0, 0)
+        scan_workers_layout.addWidget(self.scan_workers)
+        scan_workers_layout.addWidget(scan_workers_info)
+        scan_workers_widget.setLayout(scan_workers_layout)
+        frame_form.addRow("Scan workers:", scan_workers_widget)
         layout.addLayout(frame_form)
 
         # --- Add horizontal line ---
@@ -168,7 +200,7 @@ class MainWindow(QWidget):
         line2.setFrameShadow(QFrame.Shadow.Sunken)
         layout.addWidget(line2)
 
-        self.frame_widgets = [self.frame_interval]
+        self.frame_widgets = [self.frame_interval, self.full_decode, self.scan_workers]
         self.set_enabled(self.frame_widgets, False)
         self.frame_extraction_checkbox.setEnabled(False)
 
@@ -255,13 +287,99 @@ class MainWindow(QWidget):
         # mosaic_form.addRow("Mosaic length for scoring (m):", mark_length_widget)
 
 
+        registration_scale_info = QLabel(self.info_icon_html)
+        registration_scale_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">This specifies how much the frames are downscaled when they are matched. A value of 2 or 4 matches the frames faster and then refines the match at full resolution. The mosaics always use the full resolution frames. To match the frames at full resolution, set this to 1.</div>'
+        )
+        self.registration_scale = QComboBox()
+        self.registration_scale.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.registration_scale.addItems(["1", "2", "4"])
+
+        registration_scale_widget = QWidget()
+        registration_scale_layout = QHBoxLayout()
+        registration_scale_layout.setContentsMargins(0, 0, 0, 0)
+        registration_scale_layout.addWidget(self.registration_scale)
+        registration_scale_layout.addWidget(registration_scale_info)
+        registration_scale_widget.setLayout(registration_scale_layout)
+        mosaic_form.addRow("Registration downscale:", registration_scale_widget)
+
+        # Search radius (zero or positive integers only)
+        self.search_radius = QLineEdit()
+        self.search_radius.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.search_radius.setText("0")
+        self.search_radius.setValidator(QIntValidator(0, 999, self))
+
+        search_radius_info = QLabel(self.info_icon_html)
+        search_radius_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">This limits the matching of each frame to this many pixels around the movement found for the previous frame, which is faster when the camera moves steadily. Frames without a clear match in this area are matched over the whole strip. To always match over the whole strip, set this to 0.</div>'
+        )
+        search_radius_widget = QWidget()
+        search_radius_layout = QHBoxLayout()
+        search_radius_layout.setContentsMargins(0, 0, 0, 0)
+        search_radius_layout.addWidget(self.search_radius)
+        search_radius_layout.addWidget(search_radius_info)
+        search_radius_widget.setLayout(search_radius_layout)
+        mosaic_form.addRow("Search radius (pixels):", search_radius_widget)
+
+        # Number of worker processes (natural numbers only)
+        self.mosaic_workers = QLineEdit()
+        self.mosaic_workers.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.mosaic_workers.setText("1")
+        self.mosaic_workers.setValidator(QIntValidator(1, os.cpu_count(), self))
+
+        mosaic_workers_info = QLabel(self.info_icon_html)
+        mosaic_workers_info.setToolTip(
+            f'<div style="white-space:pre-line; width:240px;">This sets how many mosaics are created at the same time, each in its own process. Your computer has {os.cpu_count()} cores. Using more workers also uses more memory. To create the mosaics one at a time, set this to 1.</div>'
+        )
+        mosaic_workers_widget = QWidget()
+        mosaic_workers_layout = QHBoxLayout()
+        mosaic_workers_layout.setContentsMargins(0, 0, 0, 0)
+        mosaic_workers_layout.addWidget(self.mosaic_workers)
+        mosaic_workers_layout.addWidget(mosaic_workers_info)
+        mosaic_workers_widget.setLayout(mosaic_workers_layout)
+        mosaic_form.addRow("Mosaic workers:", mosaic_workers_widget)
+
+        # Image format of the saved mosaics
+        self.mosaic_format = QComboBox()
+        self.mosaic_format.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.mosaic_format.addItems(list(mosaic_format_options))
+        self.png_compression = QComboBox()
+        self.png_compression.addItems([str(level) for level in range(10)])
+        self.png_compression.setCurrentText("6")
+        mosaic_format_info = QLabel(self.info_icon_html)
+        mosaic_format_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">This sets how the mosaics are saved. PNG is lossless; its compression level goes from 0 (fastest, largest files) to 9 (slowest, smallest files). WebP lossless gives smaller files than PNG. JPEG is the fastest and smallest but lossy, and saves the transparency of each mosaic in a separate mask image.</div>'
+        )
+        mosaic_format_widget = QWidget()
+        mosaic_format_layout = QHBoxLayout()
+        mosaic_format_layout.setContentsMargins(0, 0, 0, 0)
+        mosaic_format_layout.addWidget(self.mosaic_format)
+        mosaic_format_layout.addWidget(self.png_compression)
+        mosaic_format_layout.addWidget(mosaic_format_info)
+        mosaic_format_widget.setLayout(mosaic_format_layout)
+        mosaic_form.addRow("Mosaic format (PNG level):", mosaic_format_widget)
+
+        # Continue an interrupted run from its checkpoint
+        self.resume_mosaics = QCheckBox("Resume interrupted run")
+        resume_mosaics_info = QLabel(self.info_icon_html)
+        resume_mosaics_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">Each mosaic is recorded in Mosaics/mosaic_checkpoint.csv as soon as it is saved. If mosaic creation was interrupted, check this to keep the mosaics already saved and continue from the first unfinished one. Use the same settings as the interrupted run.</div>'
+        )
+        resume_mosaics_widget = QWidget()
+        resume_mosaics_layout = QHBoxLayout()
+        resume_mosaics_layout.setContentsMargins(0, 0, 0, 0)
+        resume_mosaics_layout.addWidget(self.resume_mosaics)
+        resume_mosaics_layout.addWidget(resume_mosaics_info)
+        resume_mosaics_widget.setLayout(resume_mosaics_layout)
+        mosaic_form.addRow("Resume:", resume_mosaics_widget)
+
         mosaic_widget = QWidget()
         mosaic_widget.setLayout(mosaic_form)
         mosaic_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
         layout.addWidget(mosaic_widget)
 
         # self.mosaic_widgets = [self.mosaic_time, self.starting_time, self.frame_resolution, self.mark_length]
-        self.mosaic_widgets = [self.mosaic_time, self.starting_time, self.frame_resolution]
+        self.mosaic_widgets = [self.mosaic_time, self.starting_time, self.frame_resolution, self.registration_scale, self.search_radius, self.mosaic_workers, self.mosaic_format, self.png_compression, self.resume_mosaics]
         self.create_mosaics_checkbox.setEnabled(False)
         self.set_enabled(self.mosaic_widgets, False)
 
@@ -382,6 +500,76 @@ class MainWindow(QWidget):
         time_form.addRow("GNSS Synchronization time:", sync_time_widget)
 
 
+        # Number of worker processes (natural numbers only)
+        self.georef_workers = QLineEdit()
+        self.georef_workers.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.georef_workers.setText("1")
+        self.georef_workers.setValidator(QIntValidator(1, os.cpu_count(), self))
+        georef_workers_info = QLabel(self.info_icon_html)
+        georef_workers_info.setToolTip(
+            f'<div style="white-space:pre-line; width:240px;">This sets how many rectified mosaics are rendered at the same time, each in its own process. Your computer has {os.cpu_count()} cores. To render the mosaics one at a time, set this to 1.</div>'
+        )
+        georef_workers_widget = QWidget()
+        georef_workers_layout = QHBoxLayout()
+        georef_workers_layout.setContentsMargins(0, 0, 0, 0)
+        georef_workers_layout.addWidget(self.georef_workers)
+        georef_workers_layout.addWidget(georef_workers_info)
+        georef_workers_widget.setLayout(georef_workers_layout)
+        time_form.addRow("Georeference workers:", georef_workers_widget)
+
+        # Georeferenced output formats
+        self.georef_output = QComboBox()
+        self.georef_output.addItems(["KMZ", "GeoTIFF", "KMZ and GeoTIFF"])
+        self.georef_output.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        georef_output_info = QLabel(self.info_icon_html)
+        georef_output_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">KMZ exports the rectified mosaics with their captions as KMZ files for Google Earth. GeoTIFF exports every mosaic as a tiled, compressed GeoTIFF (WGS 84) with overviews, which GIS software like QGIS can load directly.</div>'
+        )
+        georef_output_widget = QWidget()
+        georef_output_layout = QHBoxLayout()
+        georef_output_layout.setContentsMargins(0, 0, 0, 0)
+        georef_output_layout.addWidget(self.georef_output)
+        georef_output_layout.addWidget(georef_output_info)
+        georef_output_widget.setLayout(georef_output_layout)
+        time_form.addRow("Georeferenced output:", georef_output_widget)
+
+        # Regionated tile pyramid for viewing large surveys
+        self.tile_pyramid = QCheckBox("Build map tiles")
+        tile_pyramid_info = QLabel(self.info_icon_html)
+        tile_pyramid_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">This also exports the mosaics as a KML tile pyramid (Tiles/doc.kml), so that Google Earth and QGIS only load the tiles visible at the current zoom. Tiles of mosaics that did not change since the last run are reused.</div>'
+        )
+        tile_pyramid_widget = QWidget()
+        tile_pyramid_layout = QHBoxLayout()
+        tile_pyramid_layout.setContentsMargins(0, 0, 0, 0)
+        tile_pyramid_layout.addWidget(self.tile_pyramid)
+        tile_pyramid_layout.addWidget(tile_pyramid_info)
+        tile_pyramid_widget.setLayout(tile_pyramid_layout)
+        time_form.addRow("Tile pyramid:", tile_pyramid_widget)
+
+        # Survey-wide orthomosaic and its resolution (0 keeps the resolution of the mosaics)
+        self.orthomosaic = QCheckBox("Build orthomosaic")
+        self.ortho_resolution = QLineEdit()
+        self.ortho_resolution.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.ortho_resolution.setText("0")
+        # Decimal resolutions such as 2.6 mm are accepted, always written with a decimal point
+        ortho_validator = QDoubleValidator(0, 99999, 2, self)
+        ortho_validator.setNotation(QDoubleValidator.StandardNotation)
+        ortho_validator.setLocale(QLocale.c())
+        self.ortho_resolution.setValidator(ortho_validator)
+        orthomosaic_info = QLabel(self.info_icon_html)
+        orthomosaic_info.setToolTip(
+            '<div style="white-space:pre-line; width:240px;">This also combines all georeferenced mosaics into one GeoTIFF of the whole survey (Orthomosaic/orthomosaic.tif). The field sets its resolution in millimeters per pixel, for example 2.5. To keep the resolution of the mosaics, set this to 0; very large surveys are then built at a coarser resolution to keep the file size bounded.</div>'
+        )
+        orthomosaic_widget = QWidget()
+        orthomosaic_layout = QHBoxLayout()
+        orthomosaic_layout.setContentsMargins(0, 0, 0, 0)
+        orthomosaic_layout.addWidget(self.orthomosaic)
+        orthomosaic_layout.addWidget(self.ortho_resolution)
+        orthomosaic_layout.addWidget(orthomosaic_info)
+        orthomosaic_widget.setLayout(orthomosaic_layout)
+        time_form.addRow("Orthomosaic (mm/pixel):", orthomosaic_widget)
+
         layout.addLayout(time_form)
 
         self.georef_widgets = [
@@ -394,12 +582,17 @@ class MainWindow(QWidget):
             self.check_columns_button, 
             self.date_picker,
             self.sync_time, 
+            self.georef_workers,
+            self.georef_output,
+            self.tile_pyramid,
+            self.orthomosaic,
+            self.ortho_resolution,
             self.GNSS_time_format,
             self.local_time_format
         ]
         self.georef_widgets_part1 = [self.gnss_file, gnss_browse]
         self.georef_widgets_part2 = [ self.time_col, self.lat_col, self.lon_col, self.depth_col, self.bearing_col, self.local_time_format, self.GNSS_time_format, self.check_columns_button,]
-        self.georef_widgets_part3 = [self.date_picker, self.sync_time]
+        self.georef_widgets_part3 = [self.date_picker, self.sync_time, self.georef_workers, self.georef_output, self.tile_pyramid, self.orthomosaic, self.ortho_resolution]
         self.set_enabled(self.georef_widgets, False)
         self.georef_checkbox.setEnabled(False)
 
@@ -576,7 +769,7 @@ class MainWindow(QWidget):
         self.set_enabled(self.georef_widgets_part2, False)
         self.set_enabled(self.georef_widgets_part3, True)
         # Update georef_widgets_part3 to avoid referencing deleted widgets
-        self.georef_widgets_part3 = [self.date_picker, self.sync_time]
+        self.georef_widgets_part3 = [self.date_picker, self.sync_time, self.georef_workers, self.georef_output, self.tile_pyramid, self.orthomosaic, self.ortho_resolution]
 
 
     def show_custom_popup(self, message, title = "Message"):
@@ -613,8 +806,16 @@ class MainWindow(QWidget):
             "output_directory": self.output_dir.text(),
             "frame_resolution": self.frame_resolution.currentText(),
             "frame_interval": self.frame_interval.text(),
+            "full_decode": self.full_decode.isChecked(),
+            "scan_workers": self.scan_workers.text(),
             "mosaic_time": self.mosaic_time.text(),
             "starting_time": self.starting_time.text(),
+            "mosaic_workers": self.mosaic_workers.text(),
+            "mosaic_format": mosaic_format_options[self.mosaic_format.currentText()],
+            "png_compression": self.png_compression.currentText(),
+            "resume_mosaics": self.resume_mosaics.isChecked(),
+            "registration_scale": self.registration_scale.currentText(),
+            "search_radius": self.search_radius.text(),
             "gnss_file": self.gnss_file.text(),
             "time_col": self.time_col.currentText(),
             "lat_col": self.lat_col.currentText(),
@@ -629,6 +830,11 @@ class MainWindow(QWidget):
         if "georeference" in self.chosen_processes:
             if self.georef_part2 == True:
                 data["sync_time"] = self.sync_time.time().toString("HH:mm:ss")
+                data["georef_workers"] = self.georef_workers.text()
+                data["georef_output"] = self.georef_output.currentText()
+                data["tile_pyramid"] = self.tile_pyramid.isChecked()
+                data["orthomosaic"] = self.orthomosaic.isChecked()
+                data["ortho_resolution"] = self.ortho_resolution.text()
                 data["date_picker"] = self.date_value
                 data["unique_dates"] = self.unique_dates
                 data["depth_status"] = self.raw_data.depth_status
@@ -656,9 +862,13 @@ class MainWindow(QWidget):
             self.show_custom_popup("Please select at least one process to run.", title="Error")
             return
 
+        if "frame_extraction" in self.chosen_processes:
+            if not data["scan_workers"].strip():
+                self.show_custom_popup("Please fill in the Scan Workers.", title="Error")
+                return
         if "create_mosaics" in self.chosen_processes:
-            if np.any([not data["mosaic_time"].strip(), not data["starting_time"].strip()]):
-                self.show_custom_popup("Please fill in the Mosaic Time and Starting Video Time.", title="Error")
+            if np.any([not data["mosaic_time"].strip(), not data["starting_time"].strip(), not data["search_radius"].strip(), not data["mosaic_workers"].strip()]):
+                self.show_custom_popup("Please fill in the Mosaic Time, Starting Video Time, Search Radius, and Mosaic Workers.", title="Error")
                 return
         if "georeference" in self.chosen_processes:
             if not data["gnss_file"].strip():
@@ -667,6 +877,12 @@ class MainWindow(QWidget):
             if self.georef_part2 == False:
                 self.show_custom_popup("Please click 'Check Columns' first", title="Error")
                 return
+            if not data["georef_workers"].strip():
+                self.show_custom_popup("Please fill in the Georeference Workers.", title="Error")
+                return
+            if data["orthomosaic"] and not self.ortho_resolution.hasAcceptableInput():
+                self.show_custom_popup("Please fill in the Orthomosaic resolution.", title="Error")
+                return
             if np.any([data["time_col"] == "NA", data["lat_col"] == "NA", data["lon_col"] == "NA"]):
                 self.show_custom_popup("Please select at least one column for Time, Latitude, and Longitude. These are essential for georeferencing, and we cannot proceed without them.", title="Error")
                 return
@@ -692,6 +908,12 @@ class MainWindow(QWidget):
         if "create_mosaics" in chosen_processes:
             mosaic_t = int(data["mosaic_time"])
             sync_vid_time = int(data["starting_time"])
+            mosaic_workers = int(data["mosaic_workers"])
+            registration_scale = int(data["registration_scale"])
+            search_radius = int(data["search_radius"])
+            image_format = data["mosaic_format"]
+            compress_level = int(data["png_compression"])
+            resume = data["resume_mosaics"]
 
         project_name = data["project_name"]
         vid_dir = data["video_folder"]
@@ -707,23 +929,48 @@ class MainWindow(QWidget):
         georef_dir = os.path.join(project_dir, "Georeferenced")
         rect_mosaics_dir = os.path.join(georef_dir, "Rectified Mosaics")
         kmz_dir = os.path.join(georef_dir, "KMZ files")
+        tiles_dir = os.path.join(georef_dir, "Tiles")
+        geotiff_dir = os.path.join(georef_dir, "GeoTIFF")
+        ortho_dir = os.path.join(georef_dir, "Orthomosaic")
         
         os.makedirs(mosaics_dir, exist_ok=True)
         os.makedirs(rect_mosaics_dir, exist_ok=True)
         os.makedirs(kmz_dir, exist_ok=True)
 
-        if "frame_extraction" in chosen_processes:
-            print("Scanning Frames")
-            scan_frames(vid_dir, mosaics_dir, int(frame_interval))
-
         if "create_mosaics" in chosen_processes:
-            print("Creating Mosaics")
             if mosaic_t == 0:
                 mosaic_t = 9999999999
-            mosaic_creation(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res)
+
+        if "frame_extraction" in chosen_processes and "create_mosaics" in chosen_processes and mosaic_workers == 1 and int(data["scan_workers"]) == 1 and not resume:
+            # Scan the frames and create the mosaics while decoding the videos only once. This pass
+            # decodes every frame, so it also covers "Decode every frame". With more scan or mosaic
+            # workers, scanning and mosaicking run as separate parallel stages instead.
+            print("Scanning Frames and Creating Mosaics")
+            scan_and_mosaic(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res, int(frame_interval), registration_scale = registration_scale, search_radius = search_radius, image_format = image_format, compress_level = compress_level)
+
+        else:
+            if "frame_extraction" in chosen_processes:
+                print("Scanning Frames")
+                scan_frames(vid_dir, mosaics_dir, int(frame_interval), full_decode = data["full_decode"], workers = int(data["scan_workers"]))
+
+            if "create_mosaics" in chosen_processes:
+                print("Creating Mosaics")
+                mosaic_creation(mosaic_t, sync_vid_time, vid_dir, mosaics_dir, video_res, workers = mosaic_workers, registration_scale = registration_scale, search_radius = search_radius, image_format = image_format, compress_level = compress_level, resume = resume)
 
         if "georeference" in chosen_processes:
-            georeference(gps_data, data, vid_dir, mosaics_dir, kmz_dir, rect_mosaics_dir)
+            if data["tile_pyramid"]:
+                os.makedirs(tiles_dir, exist_ok=True)
+            if "GeoTIFF" in data["georef_output"]:
+                os.makedirs(geotiff_dir, exist_ok=True)
+            georeference(gps_data, data, vid_dir, mosaics_dir,
+                         kmz_dir if "KMZ" in data["georef_output"] else None,
+                         rect_mosaics_dir,
+                         workers = int(data["georef_workers"]),
+                         tiles_dir = tiles_dir if data["tile_pyramid"] else None,
+                         geotiff_dir = geotiff_dir if "GeoTIFF" in data["georef_output"] else None)
+            if data["orthomosaic"]:
+                os.makedirs(ortho_dir, exist_ok=True)
+                orthomosaic(mosaics_dir, ortho_dir, workers = int(data["georef_workers"]), pixel_size = float(data["ortho_resolution"])/1000)
         
         print("Total processing time: {:.2f} seconds".format(time.time() - start_time))
         print("You may now access your processed files in: ", project_dir)
@@ -734,6 +981,7 @@ class MainWindow(QWidget):
     
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setStyleSheet("""
         QToolTip {